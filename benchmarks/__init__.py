@@ -0,0 +1,96 @@
+"""
+Benchmarks of mUSh's processing stages, runnable on a CPU-only box.
+
+Each module is a runnable script storing its results as JSON, so runs can be compared between commits:
+
+```sh
+$ python -m benchmarks.notes --output before.json
+$ git checkout other-branch
+$ python -m benchmarks.notes --compare before.json
+```
+"""
+
+import contextlib
+import io
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import msgspec
+
+
+class Result(msgspec.Struct):
+    benchmark: str
+    stage: str
+    size: str
+    seconds: float
+    """Best wall time out of all repeats"""
+    peak_bytes: int
+    """Peak memory traced by `tracemalloc` during a single run"""
+    extra: dict = {}
+
+
+def measure(run, setup=lambda: None, repeat: int = 3) -> tuple[float, int]:
+    """Times `run(setup())` `repeat` times, then once more under `tracemalloc`.
+    Only the call of `run` is measured. Returns best time and peak memory in bytes"""
+    best = float("inf")
+    # Stages may print (for instance `apply_bpm`), which would skew timings
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            state = setup()
+            started = time.perf_counter()
+            run(state)
+            best = min(best, time.perf_counter() - started)
+
+        state = setup()
+        tracemalloc.start()
+        try:
+            run(state)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return best, peak
+
+
+def _commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save(path: str, results: list[Result]):
+    data = {
+        "commit": _commit(),
+        "date": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "results": msgspec.to_builtins(results),
+    }
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        json.dump(data, file, indent=2)
+
+
+def load(path: str) -> list[Result]:
+    with open(path, "r", encoding="utf-8") as file:
+        return msgspec.convert(json.load(file)["results"], list[Result])
+
+
+def report(results: list[Result], baseline: list[Result] = None):
+    """Prints results as a table, with time & memory ratios against `baseline` when provided"""
+    previous = {(r.benchmark, r.stage, r.size): r for r in baseline or []}
+    for r in results:
+        line = f"{r.benchmark:<18} {r.stage:<20} {r.size:>6} {r.seconds * 1000:>12.3f} ms {r.peak_bytes / 1024:>12.1f} KiB"
+        if old := previous.get((r.benchmark, r.stage, r.size)):
+            line += f"  x{r.seconds / old.seconds if old.seconds else float('nan'):.2f} time"
+            line += f"  x{r.peak_bytes / old.peak_bytes if old.peak_bytes else float('nan'):.2f} memory"
+        print(line)
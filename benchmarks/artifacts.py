@@ -0,0 +1,94 @@
+"""
+Benchmarks loading of cached stage artifacts, compared with JSON used previously.
+
+```sh
+$ python -m benchmarks.artifacts --minutes 5 60 --output artifacts.json
+```
+"""
+
+import argparse
+import json
+import os
+import tempfile
+
+import msgspec
+
+from benchmarks import Result, load, measure, report, save, synthetic
+from mUSh import cache
+
+
+def _write_json(directory: str, stage: str, data):
+    cached_file = cache.path(directory, stage, "json", "json")
+    os.makedirs(cached_file.parent, exist_ok=True)
+    with open(cached_file, "w", newline="", encoding="utf-8") as file:
+        json.dump(msgspec.to_builtins(data), file)
+
+
+def _load_all(data):
+    # Memory-mapped arrays are only read once touched
+    if hasattr(data, "dtype"):
+        return {name: data[name].sum() for name in data.dtype.names}
+    return data
+
+
+def run(minutes: float, repeat: int = 3):
+    size = f"{minutes:g}m"
+    artifacts = {
+        "transcription": synthetic.utterances(minutes),
+        "pitch": synthetic.pitch_track(minutes),
+    }
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for stage, data in artifacts.items():
+            legacy = data
+            if stage == "pitch":
+                legacy = {name: data[name].tolist() for name in data.dtype.names}
+            _write_json(directory, stage, legacy)
+            cache.write(directory, stage, "binary", data)
+
+            for key in ("json", "binary"):
+                extension = next(
+                    e
+                    for e in cache.FORMATS
+                    if cache.path(directory, stage, key, e).exists()
+                )
+                seconds, peak = measure(
+                    lambda _: _load_all(cache.read(directory, stage, key)),
+                    repeat=repeat,
+                )
+                results.append(
+                    Result(
+                        f"artifacts.{extension}",
+                        stage,
+                        size,
+                        seconds,
+                        peak,
+                        {
+                            "bytes": cache.path(
+                                directory, stage, key, extension
+                            ).stat().st_size
+                        },
+                    )
+                )
+    return results
+
+
+parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+parser.add_argument(
+    "--minutes", type=float, nargs="+", default=[1, 5, 60], help="Track lengths"
+)
+parser.add_argument("--repeat", type=int, default=3)
+parser.add_argument("--output", help="Path of JSON file to store results in")
+parser.add_argument("--compare", help="Path of JSON file with previous results")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    results = []
+    for minutes in args.minutes:
+        results.extend(run(minutes, args.repeat))
+    report(results, load(args.compare) if args.compare else None)
+    for r in results:
+        print(f"{r.benchmark:<18} {r.stage:<20} {r.size:>6} {r.extra['bytes']:>12} bytes")
+    if args.output:
+        save(args.output, results)
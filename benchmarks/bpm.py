@@ -0,0 +1,111 @@
+"""
+Benchmarks BPM estimation against librosa's beat tracking of whole song at 22050 Hz,
+which `bpm.analyze_bpm` replaced, on synthetic grooves at random tempos.
+Estimation at lower rate and of a window of the song are measured too.
+
+```sh
+$ python -m benchmarks.bpm --songs 20 --minutes 3 --output bpm.json
+```
+"""
+
+import argparse
+
+import librosa
+import numpy as np
+
+from benchmarks import Result, load, measure, report, save, synthetic
+from mUSh import bpm
+from mUSh.audio_source import AudioSource
+
+
+def beat_track(source: AudioSource) -> float:
+    """Tempo as it used to be estimated"""
+    y = source.get(bpm.SAMPLE_RATE, mono=True)
+    tempo, _ = librosa.beat.beat_track(y=y, sr=bpm.SAMPLE_RATE)
+    return tempo[0]
+
+
+def run(songs: int, minutes: float, window: float, rate: int, repeat: int = 1):
+    size = f"{minutes:g}m"
+    rng = np.random.default_rng(0)
+    engines = {
+        "beat_track": beat_track,
+        "stream": bpm.analyze_bpm,
+        f"stream {rate} Hz": lambda source: bpm.analyze_bpm(source, rate=rate),
+        f"stream {window:g}s": lambda source: bpm.analyze_bpm(source, window),
+    }
+    tempos = {engine: [] for engine in engines}
+    seconds = {engine: 0.0 for engine in engines}
+    peaks = {engine: 0 for engine in engines}
+    truth = rng.uniform(70, 180, songs)
+    for seed, tempo in enumerate(truth):
+        samples = synthetic.groove(minutes, tempo, seed)
+        for engine, estimate in engines.items():
+            # Decoded samples are shared, like between stages of a song
+            setup = lambda: AudioSource(samples=samples)
+            tempos[engine].append(estimate(setup()))
+            took, peak = measure(estimate, setup, repeat=repeat)
+            seconds[engine] += took
+            peaks[engine] = max(peaks[engine], peak)
+
+    reference = np.array(tempos["beat_track"])
+    results = []
+    for engine in engines:
+        estimated = np.array(tempos[engine])
+        results.append(
+            Result(
+                "bpm",
+                engine,
+                size,
+                seconds[engine] / songs,
+                peaks[engine],
+                {
+                    "matching": float(np.mean(np.isclose(estimated, reference))),
+                    # Tempo within 4% of true one, or of it's double or half
+                    "correct": float(
+                        np.mean(
+                            np.min(
+                                np.abs(
+                                    np.log2(estimated[:, None] / truth[:, None])
+                                    - [-1, 0, 1]
+                                ),
+                                axis=1,
+                            )
+                            < np.log2(1.04)
+                        )
+                    ),
+                },
+            )
+        )
+    return results
+
+
+parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+parser.add_argument("--songs", type=int, default=10)
+parser.add_argument(
+    "--minutes", type=float, nargs="+", default=[3], help="Song lengths"
+)
+parser.add_argument(
+    "--window", type=float, default=60, help="Seconds analyzed by windowed estimation"
+)
+parser.add_argument(
+    "--rate", type=int, default=11025, help="Sample rate of faster estimation"
+)
+parser.add_argument("--repeat", type=int, default=1)
+parser.add_argument("--output", help="Path of JSON file to store results in")
+parser.add_argument("--compare", help="Path of JSON file with previous results")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    results = []
+    for minutes in args.minutes:
+        results.extend(run(args.songs, minutes, args.window, args.rate, args.repeat))
+    report(results, load(args.compare) if args.compare else None)
+    for r in results:
+        print(
+            f"{r.stage:<16} {r.size:>6} same as beat_track {r.extra['matching']:.0%}"
+            f" correct {r.extra['correct']:.0%}"
+        )
+    if args.output:
+        save(args.output, results)
@@ -0,0 +1,73 @@
+"""
+Benchmarks throughput of Ultrastar .txt decoding & encoding in files per second.
+
+```sh
+$ python -m benchmarks.codec --files 200 --output codec.json
+```
+"""
+
+import argparse
+import os
+import tempfile
+
+from benchmarks import Result, load, measure, report, save, synthetic
+from mUSh import codec
+from mUSh.song import Song
+
+
+def run(files: int, minutes: float, repeat: int = 3):
+    size = f"{files}x{minutes:g}m"
+    texts = [synthetic.chart(minutes, seed) for seed in range(files)]
+    songs = [Song.parse(text) for text in texts]
+    results = []
+
+    def record(stage, seconds, peak):
+        results.append(
+            Result(
+                "codec",
+                stage,
+                size,
+                seconds,
+                peak,
+                {"files_per_second": files / seconds},
+            )
+        )
+
+    record("decode", *measure(lambda _: [codec.decode(t) for t in texts], repeat=repeat))
+    record("parse", *measure(lambda _: [Song.parse(t) for t in texts], repeat=repeat))
+    record("encode", *measure(lambda _: [codec.encode(s) for s in songs], repeat=repeat))
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for x, text in enumerate(texts):
+            paths.append(os.path.join(directory, f"{x}.txt"))
+            with open(paths[-1], "w", newline="", encoding="utf-8") as file:
+                file.write(text)
+
+        def read(_):
+            for path in paths:
+                with open(path, "r", encoding="utf-8-sig", errors="ignore") as file:
+                    Song.parse(file.read())
+
+        record("read", *measure(read, repeat=repeat))
+    return results
+
+
+parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+parser.add_argument("--files", type=int, default=200, help="Number of charts")
+parser.add_argument(
+    "--minutes", type=float, default=4, help="Length of each song in minutes"
+)
+parser.add_argument("--repeat", type=int, default=3)
+parser.add_argument("--output", help="Path of JSON file to store results in")
+parser.add_argument("--compare", help="Path of JSON file with previous results")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    results = run(args.files, args.minutes, args.repeat)
+    report(results, load(args.compare) if args.compare else None)
+    for r in results:
+        print(f"{r.stage:<8} {r.extra['files_per_second']:>10.0f} files/s")
+    if args.output:
+        save(args.output, results)
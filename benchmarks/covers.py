@@ -0,0 +1,128 @@
+"""
+Benchmarks fetching covers of a library against a local stand-in for iTunes Search API,
+which answers after a fixed latency. Songs share albums (and so artwork), some aren't found.
+
+Each run is measured with an empty cache (cold) and again with the one it left (warm),
+counting requests which reached the server.
+
+```sh
+$ python -m benchmarks.covers --songs 200 --workers 1 8 --output covers.json
+```
+"""
+
+import argparse
+import json
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from benchmarks import Result, load, report, save
+from mUSh import cover
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """Search finds songs of `albums` albums, except every `missing` one.
+    Artwork of each album is a JPEG-sized blob"""
+
+    latency = 0.05
+    albums = 20
+    missing = 10
+    requests = 0
+    _lock = threading.Lock()
+
+    def do_GET(self):
+        with StandIn._lock:
+            StandIn.requests += 1
+        time.sleep(self.latency)
+        url = urlparse(self.path)
+        if url.path == "/search":
+            term = parse_qs(url.query)["term"][0]
+            artist, title = term.split(" - ", 1)
+            number = int(title.split()[-1])
+            results = []
+            if number % self.missing:
+                album = number % self.albums
+                host = f"http://{self.headers['Host']}"
+                results.append(
+                    {
+                        "artistName": artist,
+                        "trackName": title,
+                        "artworkUrl100": f"{host}/art/{album}/100x100bb.jpg",
+                    }
+                )
+            body = json.dumps({"resultCount": len(results), "results": results})
+            self._send(body.encode(), "application/json")
+        elif url.path.startswith("/art/"):
+            self._send(url.path.encode() * 4096, "image/jpeg")
+        else:
+            self.send_error(404)
+
+    def _send(self, body: bytes, content_type: str):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def fetch_all(songs: int, workers: int, directory: str) -> tuple[float, int, int]:
+    """Seconds, covers found & requests served for fetching covers of `songs`"""
+    StandIn.requests = 0
+    items = [("Artist", f"Song {number}", directory) for number in range(songs)]
+    started = time.perf_counter()
+    found = sum(
+        out is not None
+        for _, out in cover.fetch_covers(items, lambda item: item, workers)
+    )
+    return time.perf_counter() - started, found, StandIn.requests
+
+
+def run(songs: int, workers: list[int]):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    cover.SEARCH_URL = f"http://127.0.0.1:{server.server_port}/search"
+    results = []
+    try:
+        for count in workers:
+            with tempfile.TemporaryDirectory() as directory:
+                cover.CACHE_DIR = directory
+                for state in ["cold", "warm"]:
+                    seconds, found, served = fetch_all(songs, count, directory)
+                    results.append(
+                        Result(
+                            "covers",
+                            f"{count} workers {state}",
+                            str(songs),
+                            seconds,
+                            0,
+                            {"found": found, "requests": served},
+                        )
+                    )
+    finally:
+        server.shutdown()
+    return results
+
+
+parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+parser.add_argument("--songs", type=int, default=200)
+parser.add_argument("--workers", type=int, nargs="+", default=[1, cover.WORKERS])
+parser.add_argument("--output", help="Path of JSON file to store results in")
+parser.add_argument("--compare", help="Path of JSON file with previous results")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    results = run(args.songs, args.workers)
+    report(results, load(args.compare) if args.compare else None)
+    for r in results:
+        print(
+            f"{r.stage:<20} {r.extra['found']} covers found"
+            f" with {r.extra['requests']} requests"
+        )
+    if args.output:
+        save(args.output, results)
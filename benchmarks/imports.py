@@ -0,0 +1,122 @@
+"""
+Benchmarks startup of lightweight commands, each in a fresh interpreter: importing `mUSh.library`
+and scanning headers of a synthetic library with it, without and with library's index.
+
+Memory is peak RSS of the interpreter rather than traced by `tracemalloc`,
+as most of it is taken by imported modules. Heavy backends loaded along the way are listed.
+
+```sh
+$ python -m benchmarks.imports --songs 500 --output imports.json
+```
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from benchmarks import Result, load, report, save, synthetic
+from mUSh.library import INDEX_FILE
+
+HEAVY = [
+    "torch",
+    "tensorflow",
+    "crepe",
+    "whisperx",
+    "demucs",
+    "onnxruntime",
+    "ffmpeg",
+    "pandas",
+    "scipy",
+    "requests",
+]
+"""Modules which shouldn't be imported by lightweight commands"""
+CHILD = """
+import json, resource, sys, time
+
+started = time.perf_counter()
+import mUSh.library
+
+if len(sys.argv) > 1:
+    for _ in mUSh.library.scan_songs(sys.argv[1]):
+        pass
+seconds = time.perf_counter() - started
+# Unlike `ru_maxrss`, peak of this process only (not of parent it was forked from)
+try:
+    with open("/proc/self/status") as status:
+        rss = next(int(l.split()[1]) for l in status if l.startswith("VmHWM"))
+except OSError:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(
+    json.dumps(
+        {
+            "seconds": seconds,
+            "rss": rss * 1024,
+            "heavy": [name for name in %r if name in sys.modules],
+        }
+    )
+)
+"""
+
+
+def spawn(*args: str) -> dict:
+    """Measurements of `CHILD` run by a fresh interpreter with `args`"""
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD % HEAVY, *args],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def run(songs: int, repeat: int = 5):
+    results = []
+
+    def record(stage: str, size: str, runs: list[dict]):
+        results.append(
+            Result(
+                "imports",
+                stage,
+                size,
+                min(r["seconds"] for r in runs),
+                max(r["rss"] for r in runs),
+                {"heavy": runs[0]["heavy"]},
+            )
+        )
+
+    record("import library", "-", [spawn() for _ in range(repeat)])
+    with tempfile.TemporaryDirectory() as directory:
+        for seed in range(songs):
+            folder = os.path.join(directory, f"Song {seed}")
+            os.makedirs(folder)
+            with open(os.path.join(folder, f"{seed}.txt"), "w", encoding="utf-8") as f:
+                f.write(synthetic.chart(0.5, seed))
+
+        def scan() -> dict:
+            if os.path.exists(index := os.path.join(directory, INDEX_FILE)):
+                os.remove(index)
+            return spawn(directory)
+
+        record("scan headers", str(songs), [scan() for _ in range(repeat)])
+        record("scan indexed", str(songs), [spawn(directory) for _ in range(repeat)])
+    return results
+
+
+parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+parser.add_argument("--songs", type=int, default=500, help="Songs in library")
+parser.add_argument("--repeat", type=int, default=5)
+parser.add_argument("--output", help="Path of JSON file to store results in")
+parser.add_argument("--compare", help="Path of JSON file with previous results")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    results = run(args.songs, args.repeat)
+    report(results, load(args.compare) if args.compare else None)
+    for r in results:
+        print(f"{r.stage:<16} heavy modules: {', '.join(r.extra['heavy']) or 'none'}")
+    if args.output:
+        save(args.output, results)
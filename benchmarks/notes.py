@@ -0,0 +1,125 @@
+"""
+Benchmarks note building stages of `Song.build_notes` and `Song.dump` without running any models.
+
+```sh
+$ python -m benchmarks.notes --minutes 1 5 60 --output notes.json
+$ python -m benchmarks.notes --engine arrays collection --minutes 1 5
+```
+"""
+
+import argparse
+import copy
+
+from benchmarks import Result, load, measure, report, save, synthetic
+from mUSh import audio_notes
+from mUSh.models import Note, NoteTypes
+from mUSh.song import Song
+
+BPM = 121.3
+STAGES = [
+    "apply_bpm",
+    "merge_punctuation",
+    "merge_spaces",
+    "running_bag",
+    "merge_chars",
+    "normalize_duration",
+]
+
+
+def _match(engine: str, chars, freqs):
+    if engine == "collection":
+        return audio_notes.NoteCollection(chars, freqs)
+    return audio_notes.NoteArrays.from_pitch(chars, freqs)
+
+
+def _call(stage: str):
+    if stage == "apply_bpm":
+        return lambda notes: notes.apply_bpm(BPM)
+    return lambda notes: getattr(notes, stage)()
+
+
+def _rows(notes):
+    if isinstance(notes, audio_notes.NoteCollection):
+        return (row[:4] for row in notes.result.to_numpy())
+    return notes.rows()
+
+
+def to_notes(notes) -> list[Note]:
+    return [
+        Note(NoteTypes.NORMAL, *row)
+        if row[3] != "--"
+        else Note(NoteTypes.END_OF_PHRASE, row[0])
+        for row in _rows(notes)
+    ]
+
+
+def song(notes: list[Note]):
+    return Song(
+        title="Benchmark",
+        artist="mUSh",
+        audio="mUSh - Benchmark.mp3",
+        bpm=BPM,
+        notes=notes,
+    )
+
+
+def run(minutes: float, engine: str, repeat: int = 3, dump: bool = True):
+    size = f"{minutes:g}m"
+    chars = synthetic.utterances(minutes)
+    freqs = synthetic.pitch_track(minutes)
+    results = []
+
+    def record(stage, seconds, peak, **extra):
+        results.append(Result(f"notes.{engine}", stage, size, seconds, peak, extra))
+
+    seconds, peak = measure(
+        lambda chars: _match(engine, chars, freqs),
+        lambda: copy.deepcopy(chars),
+        repeat,
+    )
+    record("match_pitch", seconds, peak, chars=len(chars), frames=len(freqs))
+
+    notes = _match(engine, copy.deepcopy(chars), freqs)
+    for stage in STAGES:
+        seconds, peak = measure(_call(stage), lambda: copy.deepcopy(notes), repeat)
+        _call(stage)(notes)
+        record(stage, seconds, peak)
+
+    seconds, peak = measure(to_notes, lambda: notes, repeat)
+    record("to_notes", seconds, peak)
+
+    if dump:
+        result = song(to_notes(notes))
+        seconds, peak = measure(lambda song: song.dump(), lambda: result, repeat)
+        record("dump", seconds, peak, notes=len(result.notes))
+    return results
+
+
+parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+parser.add_argument(
+    "--minutes", type=float, nargs="+", default=[1, 5, 60], help="Track lengths"
+)
+parser.add_argument(
+    "--engine",
+    nargs="+",
+    default=["arrays"],
+    choices=["arrays", "collection"],
+    help="`arrays` for `NoteArrays`, `collection` for `NoteCollection` (slow on long tracks)",
+)
+parser.add_argument("--repeat", type=int, default=3)
+parser.add_argument(
+    "--no-dump", action="store_true", help="Skip `Song.dump`, which imports ML stack"
+)
+parser.add_argument("--output", help="Path of JSON file to store results in")
+parser.add_argument("--compare", help="Path of JSON file with previous results")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    results = []
+    for minutes in args.minutes:
+        for engine in args.engine:
+            results.extend(run(minutes, engine, args.repeat, not args.no_dump))
+    report(results, load(args.compare) if args.compare else None)
+    if args.output:
+        save(args.output, results)
@@ -0,0 +1,92 @@
+"""
+Benchmarks accuracy & speed of pitch engines on synthetic sung tones.
+
+Accuracy is the share of sung frames within 50 cents of true pitch, engines which can't be
+loaded (like crepe without TensorFlow) are skipped.
+
+```sh
+$ python -m benchmarks.pitch --minutes 1 --output pitch.json
+```
+"""
+
+import argparse
+
+import numpy as np
+
+from benchmarks import Result, load, measure, report, save, synthetic
+from mUSh import pitcher
+
+
+def run(minutes: float, engines: list[str], repeat: int = 3):
+    size = f"{minutes:g}m"
+    audio, truth = synthetic.sung(minutes, sr=pitcher.SAMPLE_RATE)
+    singing = truth > 0
+    results = []
+    for engine in engines:
+        predict = pitcher.ENGINES[engine].predict
+        try:
+            _, frequencies, confidences = predict(audio, pitcher.SAMPLE_RATE)
+        except (AttributeError, ImportError, FileNotFoundError) as ex:
+            print(f"Skipping {engine}: {ex}")
+            continue
+        seconds, peak = measure(
+            lambda _: predict(audio, pitcher.SAMPLE_RATE), repeat=repeat
+        )
+        frames = min(len(frequencies), len(truth))
+        cents = 1200 * np.abs(
+            np.log2(
+                frequencies[:frames][singing[:frames]]
+                / truth[:frames][singing[:frames]]
+            )
+        )
+        results.append(
+            Result(
+                "pitch",
+                engine,
+                size,
+                seconds,
+                peak,
+                {
+                    "accuracy": float(np.mean(cents < 50)),
+                    "median_cents": float(np.median(cents)),
+                    "confidence_sung": float(
+                        confidences[:frames][singing[:frames]].mean()
+                    ),
+                    "confidence_silent": float(
+                        confidences[:frames][~singing[:frames]].mean()
+                    ),
+                    "realtime": minutes * 60 / seconds,
+                },
+            )
+        )
+    return results
+
+
+parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+parser.add_argument(
+    "--minutes", type=float, nargs="+", default=[1], help="Track lengths"
+)
+parser.add_argument(
+    "--engines", nargs="+", default=list(pitcher.ENGINES), choices=list(pitcher.ENGINES)
+)
+parser.add_argument("--repeat", type=int, default=3)
+parser.add_argument("--output", help="Path of JSON file to store results in")
+parser.add_argument("--compare", help="Path of JSON file with previous results")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    results = []
+    for minutes in args.minutes:
+        results.extend(run(minutes, args.engines, args.repeat))
+    report(results, load(args.compare) if args.compare else None)
+    for r in results:
+        print(
+            f"{r.stage:<8} {r.size:>6} accuracy {r.extra['accuracy']:.1%}"
+            f" median {r.extra['median_cents']:.1f} cents"
+            f" confidence {r.extra['confidence_sung']:.2f} sung"
+            f" / {r.extra['confidence_silent']:.2f} silent"
+            f" {r.extra['realtime']:.0f}x realtime"
+        )
+    if args.output:
+        save(args.output, results)
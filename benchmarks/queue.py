@@ -0,0 +1,175 @@
+"""
+Benchmarks scaling of `daemon` over several nodes sharing a spool directory,
+with local processes standing in for nodes and stages standing in for models.
+
+Stages sleep for a time proportional to their usual cost, unless their result is in the shared
+cache. Every 10th song fails detecting pitch once, so it's retried, and in the last run one node is
+killed halfway, so it's jobs are taken over once their leases expire.
+Stages computed more than once (which leases should prevent) are counted as duplicated.
+
+```sh
+$ python -m benchmarks.queue --songs 40 --nodes 1 2 4 --output queue.json
+```
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+from benchmarks import Result, load, report, save
+from mUSh import daemon, metrics
+from mUSh.cli import logger
+from mUSh.song import STAGES, Song
+
+COST = {
+    "separation": 4.0,
+    "activity": 0.5,
+    "transcription": 2.0,
+    "pitch": 2.0,
+    "bpm": 1.0,
+}
+"""Seconds each stage takes, relative to `latency`"""
+
+
+def stand_in(stage: str, directory: str, latency: float, node: str):
+    """Method of `Song` sleeping for `stage`'s cost, or reading it's result from cache"""
+
+    def run(self: Song, *args):
+        result = Path(directory) / "cache" / f"{stage}_{self.title}"
+        if result.exists():
+            metrics.cached()
+            return
+        time.sleep(COST[stage] * latency)
+        if stage == "pitch" and int(self.title.split()[-1]) % 10 == 0:
+            try:
+                # Fails only first time
+                os.close(os.open(f"{result}.failed", os.O_CREAT | os.O_EXCL))
+                raise RuntimeError("Stand-in failure")
+            except FileExistsError:
+                pass
+        with open(Path(directory) / "work.log", "a") as log:
+            log.write(f"{node} {stage} {self.title}\n")
+        result.touch()
+
+    return run
+
+
+def batch(method):
+    """Batch method of `Song` running stand-in `method` of each song"""
+
+    def run(songs: list[Song]):
+        for song in songs:
+            method(song)
+
+    return run
+
+
+def node(spool: str, directory: str, latency: float, lease: float, name: str):
+    """Serves `spool` as node `name`, with stand-in stages"""
+    daemon.HEARTBEAT = lease / 4
+    logger.setLevel(logging.WARNING)
+    for stage, config in STAGES.items():
+        method = stand_in(stage, directory, latency, name)
+        setattr(Song, config.method, method)
+        if config.batch_method:
+            setattr(Song, config.batch_method, staticmethod(batch(method)))
+    Song.build_notes = lambda self: None
+    daemon.serve(
+        spool,
+        lambda path: Song(audio=path.name, _path=path.parent),
+        lambda song: f"{song.artist} - {song.title}",
+        poll=0.05,
+        node=name,
+        lease=lease,
+    )
+
+
+def run_nodes(
+    songs: int, nodes: int, latency: float, lease: float, kill: bool = False
+) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        spool = os.path.join(directory, "spool")
+        os.makedirs(os.path.join(directory, "cache"))
+        for number in range(songs):
+            daemon.submit(spool, f"mUSh - Song {number}.mp3")
+
+        started = time.perf_counter()
+        processes = [
+            multiprocessing.Process(
+                target=node,
+                args=(spool, directory, latency, lease, f"node{index}"),
+                daemon=True,
+            )
+            for index in range(nodes)
+        ]
+        for process in processes:
+            process.start()
+        killed = not kill
+        while True:
+            jobs = daemon.jobs(spool)
+            finished = sum(job.status in ("done", "failed") for job in jobs.values())
+            if finished == songs:
+                break
+            if not killed and finished >= songs // 2:
+                processes[0].kill()
+                killed = True
+            time.sleep(0.05)
+        seconds = time.perf_counter() - started
+        for process in processes:
+            process.kill()
+
+        with open(os.path.join(directory, "work.log")) as log:
+            work = [line.split(maxsplit=2) for line in log]
+    computed = Counter((stage, title) for _, stage, title in work)
+    return {
+        "seconds": seconds,
+        "done": sum(job.status == "done" for job in jobs.values()),
+        "retried": sum(job.attempts > 1 for job in jobs.values()),
+        "duplicated": sum(count - 1 for count in computed.values()),
+        "stages_per_node": dict(Counter(name for name, *_ in work)),
+    }
+
+
+def run(songs: int, nodes: list[int], latency: float, lease: float):
+    results = []
+    single = None
+    for count, kill in [(count, False) for count in nodes] + [(max(nodes), True)]:
+        stats = run_nodes(songs, count, latency, lease, kill)
+        single = single or stats["seconds"] * count
+        stats["speedup"] = single / stats["seconds"]
+        seconds = stats.pop("seconds")
+        stage = f"{count} nodes" + (", 1 killed" if kill else "")
+        results.append(Result("queue", stage, str(songs), seconds, 0, stats))
+    return results
+
+
+parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+parser.add_argument("--songs", type=int, default=40)
+parser.add_argument("--nodes", type=int, nargs="+", default=[1, 2, 4])
+parser.add_argument(
+    "--latency", type=float, default=0.05, help="Seconds per unit of stage's cost"
+)
+parser.add_argument(
+    "--lease", type=float, default=1.0, help="Seconds of lease of claimed jobs"
+)
+parser.add_argument("--output", help="Path of JSON file to store results in")
+parser.add_argument("--compare", help="Path of JSON file with previous results")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    results = run(args.songs, args.nodes, args.latency, args.lease)
+    report(results, load(args.compare) if args.compare else None)
+    for r in results:
+        print(
+            f"{r.stage:<18} x{r.extra['speedup']:.2f} {r.extra['done']} done"
+            f" {r.extra['retried']} retried {r.extra['duplicated']} duplicated"
+            f" stages per node {r.extra['stages_per_node']}"
+        )
+    if args.output:
+        save(args.output, results)
@@ -0,0 +1,112 @@
+"""
+Benchmarks concurrent requests for the same stage result, from several processes
+(like daemons sharing an output directory, or one audio submitted under different names).
+
+Stage is a stand-in sleeping for `--latency` seconds. Without locking, each requester
+which doesn't find the result cached computes it, with `Song.cached_stage` only the first one
+does while others wait and read it.
+
+```sh
+$ python -m benchmarks.singleflight --requesters 2 4 8 --output singleflight.json
+```
+"""
+
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from benchmarks import Result, load, report, save
+from mUSh import cache, song
+from mUSh.song import Song
+
+
+def request(directory: str, name: str, latency: float, locked: bool, start):
+    """Requests result of a stand-in stage of audio `name` once `start` is set"""
+    song.OUTPUT_DIR = directory
+
+    def compute():
+        with open(Path(directory) / "computed.log", "a") as log:
+            log.write(f"{name}\n")
+        time.sleep(latency)
+        return np.zeros(1000)
+
+    requester = Song(audio=name, _path=directory)
+    start.wait()
+    if locked:
+        requester.cached_stage("activity", compute)
+        return
+    # Checked once and written without holding a lock, as before
+    key = requester.stage_key("activity")
+    if cache.read(directory, "activity", key) is None:
+        cache.write(directory, "activity", key, compute())
+
+
+def run_requesters(requesters: int, latency: float, locked: bool) -> Result:
+    with tempfile.TemporaryDirectory() as directory:
+        names = [f"mUSh - Copy {number}.mp3" for number in range(requesters)]
+        for name in names:
+            Path(directory, name).write_bytes(b"same audio under another name")
+        start = multiprocessing.Event()
+        processes = [
+            multiprocessing.Process(
+                target=request, args=(directory, name, latency, locked, start)
+            )
+            for name in names
+        ]
+        for process in processes:
+            process.start()
+        started = time.perf_counter()
+        start.set()
+        for process in processes:
+            process.join()
+        seconds = time.perf_counter() - started
+        with open(os.path.join(directory, "computed.log")) as log:
+            computed = len(log.readlines())
+        leftovers = [
+            file
+            for file in os.listdir(os.path.join(directory, "cache"))
+            if not file.endswith(".npy")
+        ]
+    return Result(
+        "singleflight",
+        "locked" if locked else "unlocked",
+        str(requesters),
+        seconds,
+        0,
+        {"computed": computed, "leftovers": leftovers},
+    )
+
+
+def run(requesters: list[int], latency: float):
+    return [
+        run_requesters(count, latency, locked)
+        for count in requesters
+        for locked in (False, True)
+    ]
+
+
+parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+parser.add_argument("--requesters", type=int, nargs="+", default=[2, 4, 8])
+parser.add_argument(
+    "--latency", type=float, default=0.5, help="Seconds stage takes to compute"
+)
+parser.add_argument("--output", help="Path of JSON file to store results in")
+parser.add_argument("--compare", help="Path of JSON file with previous results")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    results = run(args.requesters, args.latency)
+    report(results, load(args.compare) if args.compare else None)
+    for r in results:
+        print(
+            f"{r.size:>3} {r.stage:<9} computed {r.extra['computed']} times,"
+            f" leftover files: {', '.join(r.extra['leftovers']) or 'none'}"
+        )
+    if args.output:
+        save(args.output, results)
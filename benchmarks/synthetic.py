@@ -0,0 +1,184 @@
+"""
+Synthetic stand-ins for outputs of the ML stages.
+
+`utterances` mimics character level transcription from `transcriber.transcribe` (as cached),
+`pitch_track` mimics `pitcher.detect_pitch` frames of the same performance,
+`sung` renders it as audio with it's true pitch, to measure pitch engines against,
+`groove` mixes it with drums & bass at a given tempo, to measure BPM estimation against.
+All are deterministic for a given `seed`.
+"""
+
+import numpy as np
+
+from mUSh.pitcher import PITCH_DTYPE
+
+WORDS = (
+    "I love you baby and if it's quite alright I need you to warm the lonely night "
+    "oh pretty don't bring me down pray that when you're finally mine let it be "
+    "we could dance all night under the stars never gonna give up on this heart"
+).split()
+PUNCTUATION = [",", ".", "?", "!", "...", ""]
+STEP = 0.01
+"""CREPE's default step size in seconds"""
+
+
+def performance(minutes: float, seed: int = 0) -> list[dict]:
+    """Sung characters with their timing & held note. Spaces and some punctuation are not aligned,
+    just like in whisperx output"""
+    rng = np.random.default_rng(seed)
+    length = minutes * 60
+    chars = []
+    t = rng.uniform(5, 20)  # Instrumental intro
+    while t < length:
+        words = rng.integers(3, 10)
+        center = rng.uniform(6, 18)
+        for w in range(words):
+            word = WORDS[rng.integers(len(WORDS))]
+            if w == 0:
+                word = word[0].upper() + word[1:]
+            note = center + rng.integers(-4, 5)
+            for char in word:
+                duration = round(float(rng.uniform(0.04, 0.3)), 3)
+                if rng.random() < 0.3:
+                    note = center + rng.integers(-4, 5)
+                chars.append(
+                    {
+                        "char": char,
+                        "start": round(t, 3),
+                        "end": round(t + duration, 3),
+                        "score": round(float(rng.uniform(0.3, 1)), 3),
+                        "note": float(note),
+                    }
+                )
+                t += duration
+            if w == words - 1:
+                for char in PUNCTUATION[rng.integers(len(PUNCTUATION))]:
+                    chars.append({"char": char})
+            chars.append({"char": " "})
+            t += float(rng.uniform(0, 0.15))
+        t += float(rng.uniform(0.5, 6))
+    return chars
+
+
+def utterances(minutes: float, seed: int = 0) -> list[dict]:
+    """Character level transcription, shaped like `transcriber.Utterance` records"""
+    return [
+        {k: v for k, v in char.items() if k != "note"}
+        for char in performance(minutes, seed)
+    ]
+
+
+def pitch_track(minutes: float, seed: int = 0) -> np.ndarray:
+    """Frames shaped like `pitcher.detect_pitch` result: confident & stable while singing,
+    noisy elsewhere"""
+    rng = np.random.default_rng(seed + 1)
+    sung = [c for c in performance(minutes, seed) if "start" in c]
+    times = np.arange(int(minutes * 60 / STEP)) * STEP
+
+    starts = np.array([c["start"] for c in sung])
+    ends = np.array([c["end"] for c in sung])
+    notes = np.array([c["note"] for c in sung])
+    index = np.clip(np.searchsorted(starts, times, side="right") - 1, 0, None)
+    singing = (times >= starts[index]) & (times <= ends[index])
+
+    vibrato = 0.3 * np.sin(2 * np.pi * 5.5 * times)
+    freq = np.where(
+        singing,
+        notes[index] + vibrato + rng.normal(0, 0.1, len(times)),
+        rng.uniform(-10, 30, len(times)),
+    )
+    confidence = np.where(
+        singing, rng.uniform(0.6, 0.95, len(times)), rng.uniform(0.05, 0.3, len(times))
+    )
+    result = np.empty(len(times), dtype=PITCH_DTYPE)
+    result["time"] = times
+    result["freq"] = freq
+    result["confidence"] = confidence
+    return result
+
+
+def sung(
+    minutes: float, seed: int = 0, sr: int = 16000
+) -> tuple[np.ndarray, np.ndarray]:
+    """Vocal-like audio of the performance: harmonic tones with vibrato, noise & silence.
+    Returns it with true frequency (in Hz, 0 if silent) of each `STEP`"""
+    rng = np.random.default_rng(seed + 2)
+    sung = [c for c in performance(minutes, seed) if "start" in c]
+    times = np.arange(int(minutes * 60 * sr)) / sr
+
+    starts = np.array([c["start"] for c in sung])
+    ends = np.array([c["end"] for c in sung])
+    notes = np.array([c["note"] for c in sung])
+    index = np.clip(np.searchsorted(starts, times, side="right") - 1, 0, None)
+    singing = (times >= starts[index]) & (times < ends[index])
+
+    # Same scale as `pitcher.detect_pitch` notes
+    frequency = 440 * 2 ** ((notes[index] - 21) / 12)
+    frequency *= 2 ** (0.3 * np.sin(2 * np.pi * 5.5 * times) / 12)
+    frequency = np.where(singing, frequency, 0)
+    phase = 2 * np.pi * np.cumsum(frequency) / sr
+    audio = sum(np.sin(k * phase) * 0.8**k for k in range(1, 9)) * 0.3
+    audio = audio + rng.normal(0, 0.005, len(times))
+    return audio.astype(np.float32), frequency[:: int(sr * STEP)]
+
+
+def groove(minutes: float, bpm: float, seed: int = 0, sr: int = 44100) -> np.ndarray:
+    """Stereo mix of `sung` vocals with kick, snare, hi-hats & bass at `bpm`,
+    slightly humanized. Returns float32 samples shaped as (channels, samples)"""
+    rng = np.random.default_rng(seed + 3)
+    length = int(minutes * 60 * sr)
+    drums, bass = np.zeros(length), np.zeros(length)
+    t = np.arange(int(0.4 * sr)) / sr
+    kick = np.sin(2 * np.pi * (50 * t + 60 * (1 - np.exp(-t * 30)))) * np.exp(-t * 12)
+    snare = rng.normal(0, 1, len(t)) * np.exp(-t * 25) * 0.5
+    hat = np.diff(rng.normal(0, 1, len(t) + 1)) * np.exp(-t * 80) * 0.15
+    roots = 55 * 2 ** (rng.integers(0, 12, 4) / 12)
+
+    beat = 60 / bpm
+    for i in range(int(minutes * 60 / beat * 2)):
+        start = int((i * beat / 2 + rng.normal(0, 0.004)) * sr)
+        if start < 0 or start >= length:
+            continue
+        end = min(start + len(t), length)
+        sounds = [hat * rng.uniform(0.5, 1)]
+        if i % 2 == 0:
+            sounds.append(kick if i % 4 == 0 or rng.random() < 0.2 else snare)
+            root = roots[i // 16 % len(roots)]
+            bass[start:end] += np.sin(2 * np.pi * root * t[: end - start]) * np.exp(
+                -t[: end - start] * 4
+            )
+        for sound in sounds:
+            drums[start:end] += sound[: end - start]
+
+    vocals, _ = sung(minutes, seed, sr)
+    mix = drums * 0.5 + bass * 0.3 + vocals[:length]
+    pan = rng.uniform(0.3, 0.7)
+    return np.stack((mix * pan, mix * (1 - pan))).astype(np.float32)
+
+
+def chart(minutes: float, seed: int = 0, bpm: float = 300.0) -> str:
+    """Ultrastar .txt text with notes built out of synthetic transcription & pitch"""
+    from mUSh import audio_notes, codec
+    from mUSh.models import Note, NoteTypes, Song
+
+    notes = audio_notes.NoteArrays.from_pitch(
+        utterances(minutes, seed), pitch_track(minutes, seed)
+    )
+    notes.start -= notes.start[1]
+    notes.start *= bpm / 60
+    notes.duration *= bpm / 60
+    notes.merge_punctuation().merge_spaces().running_bag().merge_chars()
+    song = Song(
+        title=f"Song {seed}",
+        artist="mUSh",
+        audio=f"mUSh - Song {seed}.mp3",
+        bpm=bpm,
+        gap=1200,
+        notes=[
+            Note(NoteTypes.NORMAL, *row)
+            if row[3] != "--"
+            else Note(NoteTypes.END_OF_PHRASE, row[0])
+            for row in notes.normalize_duration().rows()
+        ],
+    )
+    return codec.encode(song)
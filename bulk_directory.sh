@@ -2,8 +2,7 @@
 
 directory="songs"
 
-find "$directory" -type f | while read -r file; do
-    echo "Processing file: $file"
-    echo "Result: \"$file\""
-    python -m mUSh -filepath="$file"
-done
\ No newline at end of file
+# Files are processed by `python -m mUSh -daemon`, which has to be running already
+echo "Submitting files of: $directory"
+python -m mUSh -filepath="$directory" -submit
+python -m mUSh -status
@@ -1,7 +1,8 @@
 import argparse
 from pathlib import Path
 from mUSh.cli import logger
-from mUSh.song import Song
+from mUSh.song import STAGES, Song
+from mUSh import daemon, library, metrics, pitcher, registry, scheduler
 from mUSh.library import add_cover
 
 
@@ -17,32 +18,151 @@ parser.add_argument(
     help="Path to Ultrastar library",
     default="mUSh",
 )
+parser.add_argument(
+    "-task",
+    help="Maintenance task to run on songs of `library` instead of processing files",
+    choices=["list", "stems", "covers"],
+)
+parser.add_argument(
+    "-workers",
+    help="Number of workers reading songs of `library`. Default is 0 (read in this process)",
+    type=int,
+    default=0,
+)
+parser.add_argument(
+    "-executor",
+    help="Kind of workers reading songs of `library`. Default is `process`",
+    choices=["process", "thread"],
+    default="process",
+)
+parser.add_argument(
+    "-stage_executor",
+    help="Kind of workers running stages of processed files. Default is `thread`",
+    choices=["process", "thread"],
+    default="thread",
+)
+parser.add_argument(
+    "-pitch_engine",
+    help="Pitch detection engine. `yin` is fast on CPU. Default is `crepe`",
+    choices=list(pitcher.ENGINES),
+    default="crepe",
+)
+parser.add_argument(
+    "-pitch_chunk",
+    help="Detect pitch in chunks of that many seconds, for long recordings. Default is whole song",
+    type=float,
+)
+parser.add_argument(
+    "-bpm_window",
+    help="Estimate BPM from that many seconds of the middle of the song. Default is whole song",
+    type=float,
+)
+parser.add_argument(
+    "-bpm_rate",
+    help="Sample rate BPM is estimated at. 11025 is faster, but may settle on double or half tempo. Default is 22050",
+    type=int,
+)
+parser.add_argument(
+    "-daemon",
+    help="Keep running, processing files submitted to `spool`",
+    action="store_true",
+)
+parser.add_argument(
+    "-submit",
+    help="Submit `filepath` to daemon's `spool` instead of processing it here",
+    action="store_true",
+)
+parser.add_argument(
+    "-status",
+    help="Show status and timing of jobs submitted to `spool`",
+    action="store_true",
+)
+parser.add_argument(
+    "-spool",
+    help="Directory jobs of daemon are submitted to. Default is `spool`",
+    default="spool",
+)
+parser.add_argument(
+    "-metrics",
+    help="Path of file timing, memory use and cache hits of each song's stages are appended to, as JSON lines",
+)
+parser.add_argument(
+    "-profile",
+    help="Stage to profile, like `pitch` or `notes.merge_chars`. Output is stored in `out/profiles`",
+)
+parser.add_argument(
+    "-profiler",
+    help="Profiler of `profile` stage. Default is `cprofile`",
+    choices=["cprofile", "tracemalloc"],
+    default="cprofile",
+)
+
+TASKS = {
+    "list": library.list_library,
+    "stems": library.add_missing_stems,
+    "covers": library.add_missing_covers,
+}
 
 
-def process_file(path):
+def create_song(path) -> Song:
     s = Song(audio=path.name, _path=path.absolute().resolve().parent)
     logger.info("Song `%s` by `%s` initiated", s.title, s.artist)
-    s.build_notes()
+    return s
+
+
+def save_song(s: Song) -> str:
     add_cover(s)
     logger.info("Notes built")
     destination = s.move(args.library)
     logger.info("Moved to library")
     s.write(destination)
     logger.info("Written result to %s", args.output)
+    return destination
 
 
-if __name__ == "__main__":
-    args = parser.parse_args()
-    logger.info("New instance started")
-    path = Path(args.filepath)
+def files(path: Path):
+    """Files of directory at `path` (recursively), or just `path` if it's a file"""
     if path.is_dir():
         paths = path.walk()
     else:
         paths = [["", "", [path]]]
-    for parent, dirs, files in paths:
-        for file in files:
-            path = parent / file
-            try:
-                process_file(path)
-            except ValueError:
-                continue
+    for parent, dirs, names in paths:
+        for name in names:
+            yield parent / name
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    logger.info("New instance started")
+    if args.task:
+        TASKS[args.task](args.library, workers=args.workers, executor=args.executor)
+        exit()
+    if args.status:
+        print(daemon.status(args.spool))
+        exit()
+    if args.submit:
+        for path in files(Path(args.filepath)):
+            logger.info("Submitted %s as job %s", path, daemon.submit(args.spool, path))
+        exit()
+    STAGES["pitch"].options["engine"] = args.pitch_engine
+    STAGES["pitch"].resource = pitcher.ENGINES[args.pitch_engine].resource
+    if args.pitch_chunk:
+        STAGES["pitch"].options["chunk"] = args.pitch_chunk
+    if args.bpm_window:
+        STAGES["bpm"].options["window"] = args.bpm_window
+    if args.bpm_rate:
+        STAGES["bpm"].options["rate"] = args.bpm_rate
+    metrics.OUTPUT = args.metrics
+    metrics.PROFILE, metrics.PROFILER = args.profile, args.profiler
+    if args.daemon:
+        daemon.serve(args.spool, create_song, save_song, args.stage_executor)
+        exit()
+    songs = []
+    for path in files(Path(args.filepath)):
+        try:
+            songs.append(create_song(path))
+        except ValueError:
+            continue
+    for song in scheduler.run(songs, args.stage_executor):
+        save_song(song)
+    registry.release()
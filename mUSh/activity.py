@@ -0,0 +1,75 @@
+"""
+Vocal activity of separated vocals, found from loudness of short frames.
+
+Activity is an array of shape (regions, 2) with start and end (in seconds) of each region
+where something is sung. Shared by pitch detection, transcription and break insertion.
+"""
+
+import numpy as np
+
+SAMPLE_RATE = 16000
+"""Rate audio is analyzed at"""
+FRAME = 0.04
+"""Length of measured frame in seconds"""
+HOP = 0.01
+FLOOR = -60.0
+"""Frames quieter than that (in dBFS) are always silent"""
+
+
+def detect(
+    audio: np.ndarray,
+    samplerate: int,
+    threshold: float = -40.0,
+    min_silence: float = 0.3,
+    min_activity: float = 0.1,
+    padding: float = 0.2,
+) -> np.ndarray:
+    """Regions of mono `audio` louder than `threshold` dB below it's loudest frames.
+    Regions shorter than `min_activity` are dropped, remaining ones are extended by `padding`
+    and merged if they are closer than `min_silence`"""
+    hop, frame = int(samplerate * HOP), int(samplerate * FRAME)
+    count = 1 + max(len(audio) - frame, 0) // hop
+    squares = np.concatenate(([0.0], np.cumsum(np.square(audio, dtype=np.float64))))
+    starts = np.arange(count) * hop
+    ends = np.minimum(starts + frame, len(audio))
+    power = (squares[ends] - squares[starts]) / np.maximum(ends - starts, 1)
+    loudness = 10 * np.log10(np.maximum(power, 1e-20))
+    active = loudness > max(np.percentile(loudness, 99) + threshold, FLOOR)
+
+    edges = np.diff(active.astype(np.int8), prepend=0, append=0)
+    first, last = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    regions = np.stack((first * HOP, (last - 1) * HOP + FRAME), axis=1)
+    regions = regions[regions[:, 1] - regions[:, 0] >= min_activity]
+    if not len(regions):
+        return regions
+
+    regions[:, 0] -= padding
+    regions[:, 1] += padding
+    np.clip(regions, 0, len(audio) / samplerate, out=regions)
+    separate = regions[1:, 0] - regions[:-1, 1] >= min_silence
+    return np.stack(
+        (regions[np.r_[True, separate], 0], regions[np.r_[separate, True], 1]), axis=1
+    )
+
+
+def mask(audio: np.ndarray, samplerate: int, regions: np.ndarray) -> np.ndarray:
+    """Copy of `audio` silenced outside of `regions`"""
+    masked = np.zeros_like(audio)
+    for start, end in (regions * samplerate).astype(int):
+        masked[start:end] = audio[start:end]
+    return masked
+
+
+def silence(regions: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """Seconds without activity within each interval from `starts` to `ends`"""
+    lengths = regions[:, 1] - regions[:, 0]
+    before = np.concatenate(([0.0], np.cumsum(lengths)))
+
+    def active_until(time: np.ndarray) -> np.ndarray:
+        index = np.searchsorted(regions[:, 0], time, side="right") - 1
+        within = np.clip(time - regions[index, 0], 0, lengths[index])
+        return np.where(index < 0, 0.0, before[index] + within)
+
+    if not len(regions):
+        return ends - starts
+    return (ends - starts) - (active_until(ends) - active_until(starts))
@@ -3,42 +3,96 @@ import string
 import msgspec
 import numpy as np
 import pandas as pd
+from mUSh import activity
 from mUSh.bpm import get_multiplier
 
 
-def match_frequency_to_char(interval_list, freq_dict):
-    # Sort interval_list by score in descending order to prioritize high-scoring characters
-    sorted_intervals = sorted(
-        interval_list, key=lambda x: (x["start"], x["score"]), reverse=False
+PITCH_METHODS = {"confidence", "median", "weighted"}
+
+
+def _range_argmax(values: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    """Index of the first maximum of `values[lo:hi]` for every (lo, hi) pair.
+
+    Uses a sparse table, so ranges may overlap and each query is O(1).
+    Ranges must be non-empty."""
+    table = [np.arange(len(values), dtype=np.int32)]
+    width = 1
+    while width * 2 <= len(values):
+        left, right = table[-1][:-width], table[-1][width:]
+        # On ties prefer the left (earlier) index, like a stable sort would
+        table.append(np.where(values[right] > values[left], right, left))
+        width *= 2
+
+    level = np.log2(hi - lo).astype(np.int64)
+    # Guard against float rounding of log2 near powers of two
+    level -= (1 << level) > hi - lo
+    left = np.empty(len(lo), dtype=np.int64)
+    right = np.empty(len(lo), dtype=np.int64)
+    for k in np.unique(level):
+        mask = level == k
+        left[mask] = table[k][lo[mask]]
+        right[mask] = table[k][hi[mask] - (1 << k)]
+    return np.where(values[right] > values[left], right, left)
+
+
+def match_frequency_to_char(interval_list, freq_dict, method: str = "confidence"):
+    """Matches every character interval with a pitch frame that falls within it.
+
+    Frame is the one with the highest confidence within `[start, end]` (earliest on ties),
+    intervals without any frame are dropped. Pitch is taken from that frame,
+    or with `method` set to `median`/`weighted`, it's a median or confidence-weighted mean
+    of all frames within the interval.
+    Returns columns ready to be turned into a `DataFrame`."""
+    if method not in PITCH_METHODS:
+        raise ValueError(f"Unknown pitch method `{method}`")
+
+    # Order characters by start, then score (stable, like `sorted`)
+    starts = np.array([i["start"] for i in interval_list], dtype=np.float64)
+    ends = np.array([i["end"] for i in interval_list], dtype=np.float64)
+    scores = np.array([i["score"] for i in interval_list], dtype=np.float64)
+    order = np.lexsort((scores, starts))
+    starts, ends = starts[order], ends[order]
+
+    # Assuming freq_dict has 'time', 'freq', and 'confidence' keys sorted by time
+    times = np.asarray(freq_dict["time"], dtype=np.float64)
+    freqs = np.asarray(freq_dict["freq"], dtype=np.float64)
+    confidences = np.asarray(freq_dict["confidence"], dtype=np.float64)
+    if np.any(times[1:] < times[:-1]):
+        by_time = np.argsort(times, kind="stable")
+        times, freqs, confidences = times[by_time], freqs[by_time], confidences[by_time]
+
+    # Frames within each interval form a contiguous range [lo, hi)
+    lo = np.searchsorted(times, starts, side="left")
+    hi = np.searchsorted(times, ends, side="right")
+    matched = hi > lo
+    order, starts, ends, lo, hi = (
+        order[matched],
+        starts[matched],
+        ends[matched],
+        lo[matched],
+        hi[matched],
     )
 
-    # Sort frequency dictionary by confidence in descending order
-    # Assuming freq_dict has 'time', 'freq', and 'confidence' keys
-    freq_sorted = sorted(
-        zip(freq_dict["time"], freq_dict["freq"], freq_dict["confidence"]),
-        key=lambda x: x[2],
-        reverse=True,
-    )
-
-    result = []
-    for interval in sorted_intervals:
-        # Find the best matching frequency
-        best_match = None
-        for time, freq, confidence in freq_sorted:
-            # Check if the frequency time falls within the interval
-            if interval["start"] <= time <= interval["end"]:
-                best_match = {
-                    "start": time,
-                    "duration": interval["end"] - interval["start"],
-                    "pitch": freq,
-                    "char": interval["char"],
-                }
-                break  # Take the first (highest confidence) match
-
-        if best_match:
-            result.append(best_match)
+    best = _range_argmax(confidences, lo, hi) if len(lo) else lo
+    if method == "median":
+        pitch = np.array([np.median(freqs[a:b]) for a, b in zip(lo, hi)])
+    elif method == "weighted":
+        weights = np.concatenate(([0.0], np.cumsum(confidences)))
+        weighted = np.concatenate(([0.0], np.cumsum(confidences * freqs)))
+        total = weights[hi] - weights[lo]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            pitch = np.where(
+                total > 0, (weighted[hi] - weighted[lo]) / total, freqs[best]
+            )
+    else:
+        pitch = freqs[best]
 
-    return result
+    return {
+        "start": times[best],
+        "duration": ends - starts,
+        "pitch": pitch,
+        "char": [interval_list[i]["char"] for i in order],
+    }
 
 
 def fix_missing(words):
@@ -57,11 +111,11 @@ def fix_missing(words):
             w["score"] = 0
 
 
-def match_pitch(words, frequencies):
+def match_pitch(words, frequencies, method: str = "confidence"):
     fix_missing(words)
 
     # words = [w for w in words if len(w) > 1]
-    result = match_frequency_to_char(words, frequencies)
+    result = match_frequency_to_char(words, frequencies, method)
     return pd.DataFrame(result)
 
 
@@ -69,9 +123,10 @@ class NoteCollection(msgspec.Struct):
     chars: pd.DataFrame
     freqs: pd.DataFrame
     result: pd.DataFrame = None
+    pitch_method: str = "confidence"
 
     def __post_init__(self):
-        self.result = match_pitch(self.chars, self.freqs)
+        self.result = match_pitch(self.chars, self.freqs, self.pitch_method)
 
     def print(self, debug: bool = False):
         with open("notes.txt", "w", newline="", encoding="utf-8") as file:
@@ -136,8 +191,9 @@ class NoteCollection(msgspec.Struct):
         self.result = new
         return self
 
-    def insert_breaks(self):
-        """Inserts break note (char = '-') if gap > threshold between consecutive notes"""
+    def insert_breaks(self, regions: np.ndarray = None):
+        """Inserts break note (char = '-') if gap > threshold between consecutive notes.
+        With vocal activity `regions`, longer silence is a break as well"""
         threshold = 0.5
         if self.result is None or len(self.result) == 0:
             return self
@@ -148,6 +204,10 @@ class NoteCollection(msgspec.Struct):
         df["end"] = df["start"] + df["duration"]
         gaps = df["start"].shift(-1) - df["end"]
         gaps = gaps.fillna(0)
+        silent = np.zeros(len(df))
+        if regions is not None:
+            end = df["end"].to_numpy()
+            silent = activity.silence(regions, end, end + gaps.to_numpy())
 
         rows = []
         for i, row in df.iterrows():
@@ -178,7 +238,9 @@ class NoteCollection(msgspec.Struct):
             gap = gaps.iat[i]
             ch = str(row["char"])
 
-            if ch[-1] in punc_breaks and rows[-1]["char"] != "--" and gap > threshold:
+            if rows[-1]["char"] != "--" and (
+                ch[-1] in punc_breaks and gap > threshold or silent[i] > threshold
+            ):
                 start = row["end"]
             # insert break note: start at end, duration = gap, pitch = NaN, char = '-'
             if start:
@@ -194,7 +256,7 @@ class NoteCollection(msgspec.Struct):
         # sort just in case and reindex
         new = (
             new[["start", "duration", "pitch", "char"]]
-            .sort_values("start")
+            .sort_values("start", kind="stable")
             .reset_index(drop=True)
         )
         self.result = new
@@ -344,3 +406,211 @@ class NoteCollection(msgspec.Struct):
         self.result["duration"] *= m * BPM / 60
 
         return self
+
+
+class NoteArrays(msgspec.Struct):
+    """Columnar counterpart of `NoteCollection`.
+    Keeps notes as contiguous arrays and runs the same stages without per-row overhead.
+    `DataFrame` is only built when asked with `to_frame`"""
+
+    start: np.ndarray
+    duration: np.ndarray
+    pitch: np.ndarray
+    char: np.ndarray
+    """Object array of note texts, breaks are `--`"""
+
+    @classmethod
+    def from_pitch(cls, chars, freqs, pitch_method: str = "confidence") -> "NoteArrays":
+        fix_missing(chars)
+        result = match_frequency_to_char(chars, freqs, pitch_method)
+        char = np.empty(len(result["char"]), dtype=object)
+        char[:] = result["char"]
+        return cls(result["start"], result["duration"], result["pitch"], char)
+
+    def __len__(self):
+        return len(self.start)
+
+    def rows(self):
+        return zip(
+            self.start.tolist(),
+            self.duration.tolist(),
+            self.pitch.tolist(),
+            self.char.tolist(),
+        )
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(
+            {
+                "start": self.start,
+                "duration": self.duration,
+                "pitch": self.pitch,
+                "char": self.char.tolist(),
+            }
+        )
+
+    def _take(self, index):
+        self.start = self.start[index]
+        self.duration = self.duration[index]
+        self.pitch = self.pitch[index]
+        self.char = self.char[index]
+
+    def _merge_into_previous(self, extend: np.ndarray):
+        """Appends text of rows marked in `extend` to the closest previous unmarked row
+        and extends its duration to cover them. Marked rows without one are dropped"""
+        first = np.flatnonzero(~extend)
+        if len(first) == 0:
+            return self._take(first)
+        offset, groups = first[0], first - first[0]
+        ends = self.start + self.duration
+        group_ends = np.maximum.reduceat(ends[offset:], groups)
+        char = np.add.reduceat(self.char[offset:], groups)
+        self._take(first)
+        self.duration = np.where(
+            group_ends > ends[first], group_ends - self.start, self.duration
+        )
+        self.char = char
+
+    def _insert(self, index: np.ndarray, start: np.ndarray, duration):
+        """Inserts break notes before rows at `index`"""
+        self.start = np.insert(self.start, index, start)
+        self.duration = np.insert(self.duration, index, duration)
+        self.pitch = np.insert(self.pitch, index, np.nan)
+        self.char = np.insert(self.char, index, "--")
+
+    def normalize_duration(self):
+        next_start = np.append(self.start[1:], np.nan)
+        self.duration = np.where(
+            self.start + self.duration > next_start,
+            next_start - self.start,
+            self.duration,
+        )
+        return self
+
+    def running_bag(self):
+        punc_breaks = {"?", "!", ":", ".", '"'}
+        sentence = ""
+        previous = None
+        finished = np.zeros(len(self), dtype=bool)
+
+        for x, char in enumerate(self.char.tolist()):
+            if char.isupper():
+                running, sentence = sentence, char
+            else:
+                sentence += char
+                running = sentence
+                if char[-1] in punc_breaks:
+                    sentence = ""
+            finished[x] = running == previous
+            previous = running
+
+        self._insert(np.flatnonzero(finished), self.start[finished], 100)
+        return self
+
+    def insert_breaks(self, regions: np.ndarray = None):
+        """Inserts break note (char = '-') if gap > threshold between consecutive notes.
+        With vocal activity `regions`, longer silence is a break as well"""
+        threshold = 0.5
+        if len(self) == 0:
+            return self
+        punc_breaks = set(["?", "!", ":", ".", '"', " "])
+        end = self.start + self.duration
+        gaps = np.append(self.start[1:] - end[:-1], 0)
+        silent = np.zeros(len(self))
+        if regions is not None:
+            silent = activity.silence(regions, end, end + gaps)
+
+        chars = self.char.tolist()
+        leading = np.zeros(len(self), dtype=bool)
+        trailing = np.full(len(self), np.nan)
+        for i, ch in enumerate(chars):
+            start = None
+            if (
+                i != 0
+                and ch[0].isupper()
+                and ch[0] != "I"
+                and chars[i - 1] != "--"
+                # Break following previous note counts as well
+                and np.isnan(trailing[i - 1])
+            ):
+                leading[i] = True
+                start = self.start[i] - 0.01
+            if ch != "--" and (
+                ch[-1] in punc_breaks and gaps[i] > threshold or silent[i] > threshold
+            ):
+                start = end[i]
+            if start:
+                trailing[i] = start
+        closing = ~np.isnan(trailing)
+
+        # Notes keep their position between their own leading and trailing break
+        position = np.arange(len(self)) * 3
+        self.start = np.concatenate(
+            (self.start[leading] - 0.01, self.start, trailing[closing])
+        )
+        self.duration = np.concatenate(
+            (np.full(leading.sum(), 100.0), self.duration, gaps[closing])
+        )
+        self.pitch = np.concatenate(
+            (np.full(leading.sum(), np.nan), self.pitch, np.full(closing.sum(), np.nan))
+        )
+        breaks = np.empty(leading.sum() + closing.sum(), dtype=object)
+        breaks[:] = "--"
+        self.char = np.concatenate(
+            (breaks[: leading.sum()], self.char, breaks[leading.sum() :])
+        )
+        position = np.concatenate(
+            (position[leading], position + 1, position[closing] + 2)
+        )
+        self._take(np.lexsort((position, self.start)))
+        return self
+
+    def merge_chars(self):
+        """Merges chars in consecutive notes if they have the same pitch and previous char does not end with a space char"""
+        if len(self) == 0:
+            return self
+
+        pitch = np.round(np.nan_to_num(self.pitch, nan=0))
+        previous_char = self.char[:-1].astype(str)
+        extend = np.zeros(len(self), dtype=bool)
+        extend[1:] = (
+            (previous_char != "")
+            & ~np.char.endswith(previous_char, " ")
+            & (self.char[1:] != "--")
+            & (pitch[1:] == pitch[:-1])
+        )
+        self._merge_into_previous(extend)
+        return self
+
+    def merge_spaces(self):
+        """Append space to previous char. Discards space pitch and duration"""
+        if len(self) == 0:
+            return self
+
+        self._merge_into_previous(self.char == " ")
+        return self
+
+    def merge_punctuation(self):
+        """Append punctuation to previous char. Discards punctuation pitch and duration"""
+        if len(self) == 0:
+            return self
+
+        punctuation = set(string.punctuation)
+        self._merge_into_previous(
+            np.fromiter(
+                (ch in punctuation for ch in self.char.tolist()),
+                dtype=bool,
+                count=len(self),
+            )
+        )
+        return self
+
+    def apply_bpm(self, BPM: float):
+        ubpm = BPM / 4
+        m = get_multiplier(ubpm)
+        ubpm *= m
+        print("BPM:", ubpm, m)
+
+        self.start *= m * BPM / 60
+        self.duration *= m * BPM / 60
+
+        return self
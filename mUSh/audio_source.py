@@ -0,0 +1,130 @@
+"""
+Audio decoded once per song and shared by all stages.
+
+File is decoded by a single FFmpeg call into float32 samples at `SAMPLE_RATE`,
+every other sample rate (or mono mix) is resampled from it on first request and kept.
+With a `directory`, views are cached there as `.npy` files named after content of the file,
+so stages running in other processes memory map them instead of decoding the file again.
+"""
+
+import math
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from mUSh import cache
+from mUSh.cli import logger
+
+SAMPLE_RATE = 44100
+"""Rate file is decoded at, same as of demucs models"""
+CHANNELS = 2
+
+
+class AudioSource:
+    """Decoded samples of `path` (or already decoded `samples`), with views resampled on demand.
+    If `directory` is set, views of `path` are stored there as memory mapped files and reused by
+    other processes until `release`, otherwise they are kept in memory"""
+
+    def __init__(
+        self,
+        path: str = None,
+        samples: np.ndarray = None,
+        samplerate: int = SAMPLE_RATE,
+        directory: str = None,
+    ):
+        self.path = path
+        self.samplerate = samplerate
+        self.directory = directory
+        self._views: dict[tuple[int, bool], np.ndarray] = {}
+        if samples is not None:
+            self._views[(samplerate, False)] = samples
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Views are dropped when passed to another process, they are decoded again if needed
+        state = self.__dict__.copy()
+        state["_views"] = {}
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def duration(self) -> float | None:
+        """Length in seconds, if any view is decoded already"""
+        for (samplerate, _), view in self._views.items():
+            return view.shape[-1] / samplerate
+
+    def get(self, samplerate: int = None, mono: bool = False) -> np.ndarray:
+        """Float32 samples of shape (channels, samples), or (samples) if `mono`"""
+        samplerate = samplerate or self.samplerate
+        with self._lock:
+            return self._view(samplerate, mono)
+
+    def _key(self, samplerate: int, mono: bool) -> str:
+        """Cache key of a view, prefixed with content digest of file, so all can be found"""
+        channels = "mono" if mono else "stereo"
+        return f"{cache.digest(self.path)[:32]}_{samplerate}_{channels}"
+
+    def _view(self, samplerate: int, mono: bool) -> np.ndarray:
+        if (view := self._views.get((samplerate, mono))) is not None:
+            return view
+        if not (self.directory and self.path):
+            view = self._compute(samplerate, mono)
+            self._views[(samplerate, mono)] = view
+            return view
+
+        key = self._key(samplerate, mono)
+        if (view := cache.read(self.directory, "audio", key)) is None:
+            # Stages in other processes wait for it rather than decoding it as well
+            with cache.locked(cache.path(self.directory, "audio", key, "lock")):
+                if (view := cache.read(self.directory, "audio", key)) is None:
+                    view = self._compute(samplerate, mono)
+                    cache.write(self.directory, "audio", key, view)
+                    # Read back memory mapped, so it's not kept in memory
+                    view = cache.read(self.directory, "audio", key)
+        self._views[(samplerate, mono)] = view
+        return view
+
+    def _compute(self, samplerate: int, mono: bool) -> np.ndarray:
+        if samplerate != self.samplerate:
+            from scipy.signal import resample_poly
+
+            original = self._view(self.samplerate, mono)
+            gcd = math.gcd(samplerate, self.samplerate)
+            up, down = samplerate // gcd, self.samplerate // gcd
+            view = resample_poly(original, up, down, axis=-1)
+        elif mono:
+            view = self._view(samplerate, False).mean(axis=0)
+        else:
+            view = decode(self.path, samplerate)
+        return view.astype(np.float32, copy=False)
+
+    def release(self):
+        """Frees decoded samples, along with their files in `directory`"""
+        with self._lock:
+            self._views.clear()
+            if not (self.directory and self.path and os.path.exists(self.path)):
+                return
+            prefix = self._key(self.samplerate, False).split("_")[0]
+            for view in (Path(self.directory) / "cache").glob(f"audio_{prefix}_*.npy"):
+                logger.debug("Removing decoded audio %s", view)
+                view.unlink(missing_ok=True)
+
+
+def decode(path: str, samplerate: int = SAMPLE_RATE) -> np.ndarray:
+    """Decodes audio stream of `path` into float32 samples of shape (channels, samples)"""
+    import ffmpeg
+
+    logger.debug("Decoding %s at %s Hz", path, samplerate)
+    worker = (
+        ffmpeg.FFmpeg()
+        .input(path)
+        .output("pipe:1", vn=None, f="f32le", ac=CHANNELS, ar=samplerate)
+    )
+    samples = np.frombuffer(worker.execute(), dtype=np.float32)
+    return samples.reshape(-1, CHANNELS).T
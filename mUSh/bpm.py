@@ -1,12 +1,140 @@
+"""
+Tempo of the song, from onset strength envelope computed block by block.
+
+Analysis is the same as librosa's `beat_track` tempo estimation at 22050 Hz, but audio is decimated
+and reduced to mel spectrogram a block at a time, without holding whole signal, it's spectrum
+or tempogram in memory. Lower `rate` is faster, with the same tempo resolution.
+"""
+
+from itertools import chain
+from typing import Iterable, Iterator
+
 import librosa
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from mUSh.audio_source import AudioSource
+
+SAMPLE_RATE = 22050
+"""Same as `librosa.load` default"""
+N_FFT = 2048
+HOP = 512
+"""Librosa's defaults at `SAMPLE_RATE`, scaled with other rates to keep the same frame rate"""
+BLOCK = 1 << 18
+"""Samples processed at once"""
+AC_SIZE = 8.0
+"""Seconds of onset envelope autocorrelated at once, same as librosa's default"""
+TOP_DB = 80.0
+"""Quieter parts of spectrogram (relative to it's loudest one) are clipped, like in `librosa.power_to_db`"""
 
 
-def analyze_bpm(path: str):
-    y, sr = librosa.load(path)
-    tempo, beats = librosa.beat.beat_track(y=y, sr=sr)
+def analyze_bpm(
+    path: str | AudioSource, window: float = None, rate: int = SAMPLE_RATE
+) -> float:
+    """Tempo of `path`, analyzed at `rate`. If `window` (in seconds) is set,
+    only that much of the middle of the song is analyzed"""
+    if isinstance(path, AudioSource) and not path.samplerate % rate:
+        samples = path.get()
+        start, end = _window(samples.shape[-1], path.samplerate, window)
+        blocks = _decimate(_blocks(samples, start, end), path.samplerate // rate)
+    else:
+        if isinstance(path, AudioSource):
+            y = path.get(rate, mono=True)
+        else:
+            y, _ = librosa.load(path, sr=rate)
+        blocks = _blocks(y[None], *_window(len(y), rate, window))
+
+    hop = HOP * rate // SAMPLE_RATE
+    tempogram = mean_tempogram(onset_envelope(blocks, rate), rate)
+    tempo = librosa.feature.tempo(tg=tempogram[:, None], sr=rate, hop_length=hop)
     return tempo[0]
 
 
+def _window(length: int, rate: int, window: float = None) -> tuple[int, int]:
+    """Start and end of middle `window` seconds out of `length` samples at `rate`"""
+    if not window or window * rate >= length:
+        return 0, length
+    start = int((length - window * rate) // 2)
+    return start, start + int(window * rate)
+
+
+def _blocks(samples: np.ndarray, start: int, end: int) -> Iterator[np.ndarray]:
+    """Mono blocks of `samples` (shaped as channels, samples) from `start` until `end`"""
+    for first in range(start, end, BLOCK):
+        yield samples[:, first : min(first + BLOCK, end)].mean(axis=0)
+
+
+def _decimate(blocks: Iterable[np.ndarray], factor: int) -> Iterator[np.ndarray]:
+    """Low-pass filtered `blocks` with every `factor` sample kept,
+    same as `scipy.signal.resample_poly(y, 1, factor)` over all of them"""
+    from scipy.signal import firwin, upfirdn
+
+    taps = firwin(20 * factor + 1, 1 / factor, window=("kaiser", 5.0))
+    taps = taps.astype(np.float32)
+    half = len(taps) // 2
+    buffer = np.zeros(half, dtype=np.float32)
+    for block in chain(blocks, [np.zeros(half, dtype=np.float32)]):
+        buffer = np.concatenate((buffer, block))
+        if len(buffer) < len(taps):
+            continue
+        # Only outputs of taps fully within buffer, rest is computed with next block
+        count = (len(buffer) - len(taps)) // factor + 1
+        first = (len(taps) - 1) // factor
+        yield upfirdn(taps, buffer, down=factor)[first : first + count]
+        buffer = buffer[count * factor :]
+
+
+def onset_envelope(blocks: Iterable[np.ndarray], rate: int = SAMPLE_RATE) -> np.ndarray:
+    """Onset strength of mono `blocks` at `rate`, as `librosa.onset.onset_strength`
+    with median aggregation (used by `librosa.beat.beat_track`).
+    Only mel spectrogram in decibels is kept, each block's spectrum is dropped once it's reduced
+    """
+    n_fft, hop = N_FFT * rate // SAMPLE_RATE, HOP * rate // SAMPLE_RATE
+    mel = librosa.filters.mel(sr=rate, n_fft=n_fft)
+    window = librosa.filters.get_window("hann", n_fft, fftbins=True).astype(np.float32)
+    # Frames are centered, like with librosa's `center=True`
+    buffer = np.zeros(n_fft // 2, dtype=np.float32)
+    spectrogram = []
+    for block in chain(blocks, [np.zeros(n_fft // 2, dtype=np.float32)]):
+        buffer = np.concatenate((buffer, block))
+        if len(buffer) < n_fft:
+            continue
+        frames = sliding_window_view(buffer, n_fft)[::hop]
+        power = np.abs(np.fft.rfft(frames * window, axis=1)) ** 2
+        spectrogram.append(librosa.power_to_db(mel @ power.T, top_db=None))
+        buffer = buffer[len(frames) * hop :]
+
+    spectrogram = np.concatenate(spectrogram, axis=1)
+    np.maximum(spectrogram, spectrogram.max() - TOP_DB, out=spectrogram)
+    onsets = np.maximum(0.0, np.diff(spectrogram, axis=1))
+    envelope = np.median(onsets, axis=0)
+    # Compensates for lag & centering
+    envelope = np.pad(envelope, (1 + n_fft // (2 * hop), 0))
+    return envelope[: spectrogram.shape[1]]
+
+
+def mean_tempogram(
+    envelope: np.ndarray, rate: int = SAMPLE_RATE, frames: int = 512
+) -> np.ndarray:
+    """Mean over time of `librosa.feature.tempogram` of onset `envelope` at `rate` (with librosa's
+    default 8 seconds autocorrelation window), computed for that many `frames` at once
+    """
+    hop = HOP * rate // SAMPLE_RATE
+    length = librosa.time_to_frames(AC_SIZE, sr=rate, hop_length=hop).item()
+    window = librosa.filters.get_window("hann", length, fftbins=True)
+    padded = np.pad(envelope, length // 2, mode="linear_ramp", end_values=0)
+    windows = sliding_window_view(padded, length)[: len(envelope)]
+    total = np.zeros(length)
+    for first in range(0, len(windows), frames):
+        autocorrelation = librosa.autocorrelate(
+            windows[first : first + frames] * window, axis=-1
+        )
+        total += librosa.util.normalize(autocorrelation, norm=np.inf, axis=-1).sum(
+            axis=0
+        )
+    return total / len(windows)
+
+
 def get_multiplier(real_bpm: float) -> int:
     """Calculates the multiplier for the BPM"""
 
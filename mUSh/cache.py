@@ -0,0 +1,164 @@
+"""
+Content addressed cache of stage results.
+
+Keys combine content digest of input audio (or key of a stage it depends on)
+with stage name, model and its parameters, so renamed or duplicated files reuse results
+while changing a model or parameter misses previous ones.
+
+Arrays are stored as `.npy` (memory-mapped when read back), anything else as msgpack.
+Results cached as JSON by earlier versions are still read.
+
+Results are written to a temporary file first and renamed, so readers never see a partial one.
+Stages computing a result hold it's lock (see `locked`), so others wanting the same result,
+in another thread or process, wait for it and read it instead of computing it again.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+import msgspec
+import numpy as np
+
+from mUSh.cli import logger
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where results are only locked between threads
+    fcntl = None
+
+FORMATS = ["npy", "msgpack", "json"]
+"""File extensions in order of lookup"""
+_digests: dict[tuple, str] = {}
+_locks: dict[str, tuple[threading.Lock, list[int]]] = {}
+"""Lock of each key held or waited for by threads, with how many of them use it"""
+_locks_lock = threading.Lock()
+
+
+def digest(path: str | Path) -> str:
+    """SHA-256 of file's content. Remembered per path, size & modification time"""
+    stat = os.stat(path)
+    memo = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo not in _digests:
+        logger.debug("Hashing %s", path)
+        with open(path, "rb") as file:
+            _digests[memo] = hashlib.file_digest(file, "sha256").hexdigest()
+    return _digests[memo]
+
+
+def key(stage: str, source: str, model: str = None, **params) -> str:
+    """Key of `stage` result computed by `model` with `params` out of `source`"""
+    payload = msgspec.json.encode(
+        {"stage": stage, "source": source, "model": model, "params": params},
+        order="sorted",
+    )
+    return hashlib.sha256(payload).hexdigest()[:32]
+
+
+def path(directory: str | Path, stage: str, key: str, extension: str = "npy") -> Path:
+    return Path(directory) / "cache" / f"{stage}_{key}.{extension}"
+
+
+def _enc_hook(obj):
+    # NumPy scalars, for instance timestamps coming from whisperx
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise NotImplementedError(f"Objects of type {type(obj)} are not supported")
+
+
+def _load(cached_file: Path, extension: str):
+    if extension == "npy":
+        return np.load(cached_file, mmap_mode="r")
+    with open(cached_file, "rb") as file:
+        if extension == "msgpack":
+            return msgspec.msgpack.decode(file.read())
+        return json.load(file)
+
+
+@contextmanager
+def thread_locked(key: str) -> Iterator[None]:
+    """Holds lock of `key` shared by threads of this process.
+    It's forgotten once no thread holds or waits for it, so keys don't accumulate"""
+    with _locks_lock:
+        lock, users = _locks.setdefault(key, (threading.Lock(), [0]))
+        users[0] += 1
+    try:
+        if not lock.acquire(blocking=False):
+            logger.debug("Waiting for %s held by another thread", key)
+            lock.acquire()
+        try:
+            yield
+        finally:
+            lock.release()
+    finally:
+        with _locks_lock:
+            users[0] -= 1
+            if not users[0]:
+                del _locks[key]
+
+
+@contextmanager
+def locked(lock_file: str | Path) -> Iterator[None]:
+    """Holds exclusive lock of an artifact, waiting while another thread or process holds it.
+    Lock of a process is released by the OS if it dies, and `lock_file` is removed once released.
+    Whoever waited should check whether artifact exists now, before computing it again
+    """
+    lock_file = os.path.abspath(lock_file)
+    with thread_locked(lock_file):
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(os.path.dirname(lock_file), exist_ok=True)
+        while True:
+            file = open(lock_file, "ab")
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.info("Waiting for %s held by another process", lock_file)
+                fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                if os.path.samestat(os.fstat(file.fileno()), os.stat(lock_file)):
+                    break
+            except FileNotFoundError:
+                pass
+            # Removed by previous holder while this one waited, it has to be locked anew
+            file.close()
+        try:
+            yield
+        finally:
+            # Removed while still held, so whoever waited for it notices
+            os.remove(lock_file)
+            file.close()
+
+
+def write(directory: str | Path, stage: str, key: str, data):
+    extension = "npy" if isinstance(data, np.ndarray) else "msgpack"
+    cached_file = path(directory, stage, key, extension)
+    logger.debug("Caching result %s to %s", stage, cached_file)
+    os.makedirs(cached_file.parent, exist_ok=True)
+    # Unique per process, as results fetched from network (covers) aren't locked
+    partial = f"{cached_file}.{os.getpid()}.tmp"
+    with open(partial, "wb") as file:
+        if extension == "npy":
+            np.save(file, data, allow_pickle=False)
+        else:
+            file.write(msgspec.msgpack.encode(data, enc_hook=_enc_hook))
+    os.replace(partial, cached_file)
+
+
+def read(directory: str | Path, stage: str, key: str):
+    for extension in FORMATS:
+        cached_file = path(directory, stage, key, extension)
+        if not os.path.exists(cached_file):
+            continue
+        logger.debug("Reading cached data of %s from %s", stage, cached_file)
+        try:
+            return _load(cached_file, extension)
+        except (ValueError, EOFError, msgspec.DecodeError):
+            logger.warning("Cached %s is invalid. Removing.", cached_file)
+            os.remove(cached_file)
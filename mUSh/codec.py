@@ -0,0 +1,92 @@
+"""
+Codec of Ultrastar's .txt format.
+
+Notes are split in one pass and converted to `Note`s with a single `msgspec.convert` call,
+output is joined from lines at once.
+Headers can be decoded on their own, without reading notes.
+"""
+
+from typing import BinaryIO, Iterable, Iterator
+
+from mUSh.models import NoteTypes, Song
+
+HEADERS = [a for a in Song.__annotations__ if not a.startswith("_") and a != "notes"]
+"""Header fields in order they are written in"""
+FLOATS = {a for a in HEADERS if Song.__annotations__[a] is float}
+_TYPES = {t: t.value for t in NoteTypes}
+
+
+def _decode_header(line: str, data: dict):
+    line = line.strip()
+    key, value = line.split(":", 1)
+    if value and value[0].isdigit() or len(value) > 1 and value[1].isdigit():
+        value = value.replace(",", ".")
+    data[key.strip("#").lower()] = value
+
+
+def decode_lines(lines: Iterable[str], data: dict) -> dict:
+    """Decodes lines into `data`, which has to contain `notes` list"""
+    notes = data["notes"]
+    for line in lines:
+        if line == "E":
+            continue
+        elif line.startswith("#"):
+            _decode_header(line, data)
+        else:
+            row = line.split(" ", 4)
+            if "" in row:
+                row = [i for i in row if i]
+            notes.append(row)
+    return data
+
+
+def decode(text: str) -> dict:
+    """Decodes text into dict of lowercase headers & `notes` as rows of `Note` fields"""
+    if not text.startswith("#"):
+        raise TypeError("Not a valid .txt file")
+    return decode_lines(text.splitlines(), {"notes": []})
+
+
+def decode_headers(file: BinaryIO) -> tuple[dict, int]:
+    """Decodes headers of file opened in binary mode, stopping at first note line.
+    Returns them along with offset at which notes start"""
+    data = {}
+    offset = 0
+    for raw in file:
+        line = raw.decode("utf-8-sig" if not offset else "utf-8", errors="ignore")
+        if not line.startswith("#"):
+            break
+        offset += len(raw)
+        _decode_header(line, data)
+    if not offset:
+        raise TypeError("Not a valid .txt file")
+    return data, offset
+
+
+def encode_header(attribute: str, value) -> str:
+    if attribute in FLOATS:
+        return f"#{attribute.upper()}:{value:.2f}\n"
+    return f"#{attribute.upper()}:{value}\n"
+
+
+def iter_encode(song: Song) -> Iterator[str]:
+    """Yields lines of song, headers first. Last one (`E`) doesn't end with new line"""
+    for attribute in HEADERS:
+        if not (value := getattr(song, attribute)):
+            continue
+        yield encode_header(attribute, value)
+
+    # Same as `Note.__str__`, without a method call per note
+    types = _TYPES
+    for note in song.notes:
+        if note.pitch:
+            yield f"{types[note.note_type]} {note.start_beat:.0f} {note.length:.0f} {note.pitch:.0f} {note.text}\n"
+        elif note.length:
+            yield f"{types[note.note_type]} {note.start_beat:.0f} {note.length:.0f}\n"
+        else:
+            yield f"{types[note.note_type]} {note.start_beat:.0f}\n"
+    yield "E"
+
+
+def encode(song: Song) -> str:
+    return "".join(iter_encode(song))
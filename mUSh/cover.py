@@ -1,16 +1,115 @@
+"""
+Cover art from iTunes Search API.
+
+Requests share a pooled session, retried with backoff and rate limited per host.
+Responses (including searches with no results and missing artwork) are cached on disk by URL,
+so songs of the same album download artwork once and re-runs don't hit the network.
+"""
+
+import json
+import threading
+import time
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import TypeVar
+from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
+from mUSh import cache
 from mUSh.cli import logger
 
+SEARCH_URL = "https://itunes.apple.com/search"
+CACHE_DIR = "out"
+"""Directory responses are cached in, same as `song.OUTPUT_DIR`"""
+WORKERS = 8
+"""Covers fetched at once"""
+RATE_LIMITS = {"itunes.apple.com": 20 / 60}
+"""Requests per second allowed per host"""
+CACHED_STATUSES = {200, 404}
+"""Responses cached. Others (like rate limiting or server errors) are requested again next time"""
+
+T = TypeVar("T")
+_session: requests.Session = None
+_limiters: dict[str, "_Limiter"] = {}
+_lock = threading.Lock()
+
+
+class _Limiter:
+    """Spaces calls of `wait` evenly, to at most `rate` per second across threads"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def session() -> requests.Session:
+    """Session shared by all requests, with connection pool sized for `WORKERS`"""
+    global _session
+    with _lock:
+        if _session is None:
+            retry = Retry(
+                total=3,
+                backoff_factor=1,
+                status_forcelist=[429, 500, 502, 503, 504],
+                respect_retry_after_header=True,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=WORKERS, pool_maxsize=WORKERS, max_retries=retry
+            )
+            _session = requests.Session()
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+def _get(url: str, params: dict = None) -> tuple[int, bytes] | None:
+    """Status & content of response to `url`, from cache if it was requested before.
+    Concurrent requests of the same `url` wait for the first one. `None` if request failed
+    """
+    key = cache.key("http", url, **(params or {}))
+    with cache.thread_locked(key):
+        if (cached := cache.read(CACHE_DIR, "covers", key)) is not None:
+            return cached["status"], cached["content"]
+
+        host = urlparse(url).hostname
+        if host in RATE_LIMITS:
+            with _lock:
+                limiter = _limiters.setdefault(host, _Limiter(RATE_LIMITS[host]))
+            limiter.wait()
+        try:
+            resp = session().get(url, params=params, timeout=10)
+        except requests.RequestException as exc:
+            logger.debug(f"[!] Request to {url} failed: {exc}")
+            return None
+        if resp.status_code in CACHED_STATUSES:
+            cache.write(
+                CACHE_DIR,
+                "covers",
+                key,
+                {"status": resp.status_code, "content": resp.content},
+            )
+        return resp.status_code, resp.content
+
 
 def _itunes_search(artist: str, title: str) -> dict | None:
     """
     Query the iTunes Search API for a specific track.
     Returns the first matching result dictionary or None if nothing matches.
     """
-    base_url = "https://itunes.apple.com/search"
     # iTunes expects a single term; we combine artist and title for better precision.
     params = {
         "term": f"{artist} - {title}",
@@ -20,11 +119,13 @@ def _itunes_search(artist: str, title: str) -> dict | None:
         "explicit": "yes",  # include explicit tracks
     }
 
+    response = _get(SEARCH_URL, params)
+    if not response or response[0] != 200:
+        logger.debug(f"[!] iTunes lookup failed: {response and response[0]}")
+        return None
     try:
-        resp = requests.get(base_url, params=params, timeout=10)
-        resp.raise_for_status()
-        data = resp.json()
-    except Exception as exc:
+        data = json.loads(response[1])
+    except ValueError as exc:
         logger.debug(f"[!] iTunes lookup failed: {exc}")
         return None
 
@@ -73,11 +174,9 @@ def fetch_cover(artist: str, title: str, out_dir: str = ".") -> Path | None:
         logger.debug("[!] No artwork URL found in the iTunes response.")
         return None
 
-    try:
-        img_resp = requests.get(img_url, timeout=10)
-        img_resp.raise_for_status()
-    except Exception as exc:
-        logger.debug(f"[!] Failed to download artwork: {exc}")
+    response = _get(img_url)
+    if not response or response[0] != 200:
+        logger.debug(f"[!] Failed to download artwork: {response and response[0]}")
         return None
 
     # Build a safe filename: Artist - Title.jpg
@@ -85,9 +184,29 @@ def fetch_cover(artist: str, title: str, out_dir: str = ".") -> Path | None:
     out_path = Path(out_dir) / f"{safe_name}.jpg"
 
     try:
-        out_path.write_bytes(img_resp.content)
+        out_path.write_bytes(response[1])
         logger.debug(f"[+] Cover saved to: {out_path.resolve()}")
         return out_path
     except Exception as exc:
         logger.debug(f"[!] Could not write file: {exc}")
         return None
+
+
+def fetch_covers(
+    items: Iterable[T],
+    song: Callable[[T], tuple[str, str, str]],
+    workers: int = WORKERS,
+) -> Iterator[tuple[T, Path | None]]:
+    """Covers of `items` (with artist, title & output directory given by `song`),
+    fetched by `workers` threads. Yielded in order of `items`, with at most twice as many
+    as `workers` in flight"""
+    with ThreadPoolExecutor(workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append((item, executor.submit(fetch_cover, *song(item))))
+            if len(pending) >= 2 * workers:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
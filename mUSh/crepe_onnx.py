@@ -0,0 +1,164 @@
+"""
+CREPE run through ONNX Runtime on CPU, without TensorFlow.
+
+Models are exported once from crepe's Keras weights, on a machine which has TensorFlow & tf2onnx:
+
+```sh
+$ python -m mUSh.crepe_onnx full tiny
+```
+
+Framing, confidence, local weighted average & Viterbi smoothing match `crepe.predict`.
+"""
+
+import os
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from mUSh import registry
+
+MODEL_PATH = "models/crepe-{capacity}.onnx"
+CAPACITIES = ["tiny", "small", "medium", "large", "full"]
+SAMPLE_RATE = 16000
+FRAME = 1024
+BINS = 360
+CENTS = np.linspace(0, 7180, BINS) + 1997.3794084376191
+"""Cents of each activation bin"""
+BATCH = 512
+"""Frames passed to the model at once"""
+
+
+def load_model(capacity: str):
+    import onnxruntime
+
+    path = MODEL_PATH.format(capacity=capacity)
+    if not os.path.exists(path):
+        raise FileNotFoundError(
+            f"{path} is missing, export it with `python -m mUSh.crepe_onnx {capacity}`"
+        )
+    return onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+
+
+def activation(
+    audio: np.ndarray, sr: int, model_capacity: str = "full", step_size: int = 10
+) -> np.ndarray:
+    """Salience of each pitch bin in each frame, same as `crepe.get_activation`"""
+    if audio.ndim == 2:
+        audio = audio.mean(axis=1)
+    audio = audio.astype(np.float32)
+    if sr != SAMPLE_RATE:
+        from scipy.signal import resample_poly
+
+        gcd = np.gcd(sr, SAMPLE_RATE)
+        audio = resample_poly(audio, SAMPLE_RATE // gcd, sr // gcd).astype(np.float32)
+    audio = np.pad(audio, FRAME // 2)
+    hop = int(SAMPLE_RATE * step_size / 1000)
+    frames = sliding_window_view(audio, FRAME)[::hop]
+
+    session = registry.PITCH.get(
+        ("crepe-onnx", model_capacity), lambda: load_model(model_capacity)
+    )
+    name = session.get_inputs()[0].name
+    result = np.empty((len(frames), BINS), dtype=np.float32)
+    for first in range(0, len(frames), BATCH):
+        batch = frames[first : first + BATCH] - frames[first : first + BATCH].mean(
+            axis=1, keepdims=True
+        )
+        batch /= np.clip(batch.std(axis=1, keepdims=True), 1e-8, None)
+        result[first : first + BATCH] = session.run(None, {name: batch})[0]
+    return result
+
+
+def local_average_cents(salience: np.ndarray, center: np.ndarray = None) -> np.ndarray:
+    """Average of cents around `center` bin of each frame (argmax by default),
+    weighted by salience"""
+    if center is None:
+        center = salience.argmax(axis=1)
+    bins = center[:, None] + np.arange(-4, 5)
+    valid = (bins >= 0) & (bins < BINS)
+    bins = bins.clip(0, BINS - 1)
+    weights = np.take_along_axis(salience, bins, axis=1) * valid
+    return (weights * CENTS[bins]).sum(axis=1) / weights.sum(axis=1)
+
+
+def _transitions() -> np.ndarray:
+    """Log probabilities of moving to bin `j` from `j - offset`, shaped (offsets, bins)
+    for offsets from 11 down to -11"""
+    offsets = np.arange(11, -12, -1)[:, None]
+    target = np.arange(BINS)[None, :]
+    source = target - offsets
+    # crepe: transition = max(12 - |i - j|, 0), normalized by rows (source bins)
+    sources = np.arange(BINS)[:, None]
+    totals = np.maximum(12 - np.abs(sources - np.arange(BINS)[None, :]), 0).sum(axis=1)
+    with np.errstate(divide="ignore"):
+        probability = (12 - np.abs(offsets)) / totals[source.clip(0, BINS - 1)]
+        return np.where((source >= 0) & (source < BINS), np.log(probability), -np.inf)
+
+
+def viterbi_cents(salience: np.ndarray) -> np.ndarray:
+    """Cents along most likely path of bins, same as crepe's `to_viterbi_cents`.
+    Transitions are banded, so each step only looks at 23 neighbouring bins"""
+    transitions = _transitions()
+    observations = salience.argmax(axis=1)
+    matching, other = np.log(0.1 + 0.9 / BINS), np.log(0.9 / BINS)
+
+    def emission(observation: int) -> np.ndarray:
+        result = np.full(BINS, other)
+        result[observation] = matching
+        return result
+
+    score = np.log(np.full(BINS, 1 / BINS)) + emission(observations[0])
+    pointers = np.empty((len(observations), BINS), dtype=np.int16)
+    bins = np.arange(BINS)
+    for i in range(1, len(observations)):
+        padded = np.pad(score, 11, constant_values=-np.inf)
+        candidates = sliding_window_view(padded, BINS) + transitions
+        # Ties go to the highest source bin, like in hmmlearn used by crepe
+        best = 22 - candidates[::-1].argmax(axis=0)
+        score = candidates[best, bins] + emission(observations[i])
+        pointers[i] = bins - 11 + best
+
+    path = np.empty(len(observations), dtype=np.intp)
+    path[-1] = score.argmax()
+    for i in range(len(observations) - 1, 0, -1):
+        path[i - 1] = pointers[i, path[i]]
+    return local_average_cents(salience, path)
+
+
+def predict(
+    audio: np.ndarray,
+    sr: int,
+    step_size: int = 10,
+    model_capacity: str = "full",
+    viterbi: bool = True,
+):
+    """Times, frequencies & confidences of frames, same as `crepe.predict`"""
+    salience = activation(audio, sr, model_capacity, step_size)
+    confidence = salience.max(axis=1)
+    cents = viterbi_cents(salience) if viterbi else local_average_cents(salience)
+    frequency = 10 * 2 ** (cents / 1200)
+    frequency[np.isnan(frequency)] = 0
+    return np.arange(len(confidence)) * step_size / 1000, frequency, confidence
+
+
+def export(capacity: str):
+    """Exports crepe's Keras model of `capacity` to `MODEL_PATH`"""
+    import tensorflow as tf
+    import tf2onnx
+    from crepe.core import build_and_load_model
+
+    path = MODEL_PATH.format(capacity=capacity)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    model = build_and_load_model(capacity)
+    signature = [tf.TensorSpec((None, FRAME), tf.float32, name="input")]
+    tf2onnx.convert.from_keras(model, input_signature=signature, output_path=path)
+    return path
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Exports CREPE models to ONNX")
+    parser.add_argument("capacities", nargs="+", choices=CAPACITIES)
+    for capacity in parser.parse_args().capacities:
+        print("Exported", export(capacity))
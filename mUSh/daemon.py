@@ -0,0 +1,334 @@
+"""
+Long-running worker processing files submitted to a spool directory.
+
+Interpreter stays warm and models stay loaded (see `registry`) between songs, so short tracks
+aren't dominated by imports and model loading like with a process per file.
+Each job is a JSON file in the spool directory, named after it's id, which the daemon updates
+with status and timing. Jobs claimed at once are scheduled together, so their stages overlap
+like with a directory passed to `-filepath`.
+
+Several nodes can serve the same spool on a shared filesystem (along with shared `out` cache).
+Jobs are claimed under a lease, renewed by a heartbeat while they are processed. Jobs of a node
+which stopped renewing them are taken over by others once the lease expires, and failed ones are
+retried. Stages finished before are read from the shared cache, so no work is repeated,
+and each job records which node computed which stage.
+Updates of jobs are serialized by `cache.locked` on the spool's lock file. It's `flock` is
+supported by NFSv4 and released by the OS when it's holder dies, so a crashed node never leaves
+the spool locked, and a slow one is never broken into. Job files are scanned outside of the lock,
+and only candidates are read again while holding it.
+
+```sh
+$ python -m mUSh -daemon -spool spool &
+$ python -m mUSh -filepath songs -submit -spool spool
+$ python -m mUSh -status -spool spool
+```
+"""
+
+import os
+import socket
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Callable
+
+import msgspec
+
+from mUSh import cache, registry, scheduler
+from mUSh.cli import logger
+from mUSh.song import Song
+
+POLL = 1.0
+"""Seconds between looking for new jobs"""
+NODE = f"{socket.gethostname()}-{os.getpid()}"
+"""Name of this node, recorded in jobs it works on"""
+BATCH = 4
+"""Jobs claimed at once"""
+LEASE = 60.0
+"""Seconds a claimed job is reserved for it's node, unless renewed"""
+HEARTBEAT = 10.0
+"""Seconds between renewals of leases"""
+ATTEMPTS = 3
+"""Times a job is tried before it's failed"""
+
+
+class Job(msgspec.Struct):
+    path: str
+    status: str = "queued"
+    """Either `queued`, `running`, `done` or `failed`"""
+    submitted: float | None = None
+    started: float | None = None
+    finished: float | None = None
+    destination: str | None = None
+    """Library directory song was moved to"""
+    error: str | None = None
+    node: str | None = None
+    """Node which works on the job, or worked on it last"""
+    lease: float | None = None
+    """Time until which job is reserved for `node`"""
+    attempts: int = 0
+    stages: dict[str, str] = {}
+    """Node which computed each stage"""
+
+    @property
+    def seconds(self) -> float | None:
+        """Time it took from being picked up until finished"""
+        if self.started and self.finished:
+            return self.finished - self.started
+
+
+def save(spool: str, job_id: str, job: Job):
+    job_file = os.path.join(spool, f"{job_id}.json")
+    with open(job_file + ".tmp", "wb") as file:
+        file.write(msgspec.json.encode(job))
+    os.replace(job_file + ".tmp", job_file)
+
+
+def jobs(spool: str, job_ids: list[str] = None) -> dict[str, Job]:
+    """Jobs of `spool` (or just `job_ids` of them), in order they were submitted"""
+    result = {}
+    if job_ids is None:
+        job_files = sorted(Path(spool).glob("*.json"))
+    else:
+        job_files = [Path(spool) / f"{job_id}.json" for job_id in job_ids]
+    for job_file in job_files:
+        if not job_file.exists():
+            continue
+        try:
+            result[job_file.stem] = msgspec.json.decode(job_file.read_bytes(), type=Job)
+        except msgspec.DecodeError as ex:
+            logger.warning("Job %s is invalid due to %s. Skipping.", job_file, ex)
+    return result
+
+
+def submit(spool: str, path: str | Path) -> str:
+    """Queues processing of file at `path`. Returns id of the job"""
+    os.makedirs(spool, exist_ok=True)
+    job_id = f"{time.time_ns():x}-{uuid.uuid4().hex[:8]}"
+    save(spool, job_id, Job(str(Path(path).absolute()), submitted=time.time()))
+    return job_id
+
+
+def _locked(spool: str):
+    """Holds lock of whole spool, serializing updates of jobs between nodes"""
+    return cache.locked(os.path.join(spool, ".lock"))
+
+
+def _claimable(job: Job, now: float) -> bool:
+    return job.status == "queued" or (
+        job.status == "running" and (job.lease or 0) < now
+    )
+
+
+def claim(
+    spool: str, count: int = BATCH, node: str = NODE, lease: float = LEASE
+) -> dict[str, Job]:
+    """Reserves up to `count` jobs for `node`. Queued ones are claimed in order they were
+    submitted, as well as running ones which lease expired (as their node stopped)"""
+    claimed = {}
+    # Scanned without holding the lock, candidates are checked again once it's held
+    candidates = [
+        job_id for job_id, job in jobs(spool).items() if _claimable(job, time.time())
+    ]
+    if not candidates:
+        return claimed
+    with _locked(spool):
+        now = time.time()
+        for job_id in candidates:
+            if len(claimed) >= count:
+                break
+            job = jobs(spool, [job_id]).get(job_id)
+            if not job or not _claimable(job, now):
+                continue
+            if job.status == "running":
+                logger.info("Lease of job %s held by %s expired", job_id, job.node)
+                if job.attempts >= ATTEMPTS:
+                    job.status, job.error = "failed", f"Lease of {job.node} expired"
+                    job.lease, job.finished = None, now
+                    save(spool, job_id, job)
+                    continue
+            job.status, job.node, job.lease = "running", node, now + lease
+            job.started, job.attempts = now, job.attempts + 1
+            save(spool, job_id, job)
+            claimed[job_id] = job
+    return claimed
+
+
+def renew(
+    spool: str, job_ids: list[str], node: str = NODE, lease: float = LEASE
+) -> set[str]:
+    """Extends leases of `job_ids` held by `node`. Returns ids of ones taken over by others"""
+    lost = set()
+    with _locked(spool):
+        for job_id in job_ids:
+            job = jobs(spool, [job_id]).get(job_id)
+            if job and job.status == "running" and job.node == node:
+                job.lease = time.time() + lease
+                save(spool, job_id, job)
+            else:
+                lost.add(job_id)
+    return lost
+
+
+def _update(
+    spool: str, job_id: str, change: Callable[[Job], None], node: str = NODE
+) -> Job | None:
+    """Applies `change` to job, unless it was taken over by another node"""
+    with _locked(spool):
+        job = jobs(spool, [job_id]).get(job_id)
+        if not job or job.status != "running" or job.node != node:
+            logger.warning("Job %s was taken over by another node", job_id)
+            return None
+        change(job)
+        job.lease = None
+        save(spool, job_id, job)
+    return job
+
+
+class _Heartbeat(threading.Thread):
+    """Renews leases of `job_ids` until stopped. Ones taken over by others are dropped"""
+
+    def __init__(
+        self, spool: str, job_ids: set[str], node: str = NODE, lease: float = LEASE
+    ):
+        super().__init__(daemon=True)
+        self.spool, self.job_ids, self.node, self.lease = spool, job_ids, node, lease
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(HEARTBEAT):
+            for job_id in renew(self.spool, list(self.job_ids), self.node, self.lease):
+                logger.warning("Lease of job %s was lost", job_id)
+                self.job_ids.discard(job_id)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def _stages(song: Song | None, node: str) -> dict[str, str]:
+    """Stages of `song` computed by `node`, rather than read from cache"""
+    if song is None or song._metrics is None:
+        return {}
+    return {
+        measurement.stage: node
+        for measurement in song._metrics.stages
+        if not measurement.cached and "." not in measurement.stage
+    }
+
+
+def process(
+    spool: str,
+    claimed: dict[str, Job],
+    create: Callable[[Path], Song],
+    finish: Callable[[Song], str],
+    executor: str = "thread",
+    node: str = NODE,
+    lease: float = LEASE,
+):
+    """Runs `claimed` jobs through `create`, `scheduler` and `finish`,
+    which returns where song was written to. Failed jobs are queued again,
+    until they were tried `ATTEMPTS` times"""
+    songs = []
+    ids = {}
+    heartbeat = _Heartbeat(spool, set(claimed), node, lease)
+    heartbeat.start()
+
+    def failed(job_id: str, error: str, song: Song = None):
+        heartbeat.job_ids.discard(job_id)
+
+        def change(job: Job):
+            job.finished, job.error = time.time(), error
+            job.stages = job.stages | _stages(song, node)
+            job.status = "queued" if job.attempts < ATTEMPTS else "failed"
+
+        if (job := _update(spool, job_id, change, node)) and job.status == "queued":
+            logger.info("Job %s will be tried again", job_id)
+
+    def done(job_id: str, song: Song, destination: str):
+        heartbeat.job_ids.discard(job_id)
+
+        def change(job: Job):
+            job.status, job.finished = "done", time.time()
+            job.destination, job.error = destination, None
+            job.stages = job.stages | _stages(song, node)
+
+        if job := _update(spool, job_id, change, node):
+            logger.info("Finished job %s in %.1fs", job_id, job.seconds)
+
+    try:
+        for job_id, job in claimed.items():
+            try:
+                song = create(Path(job.path))
+            except Exception as ex:
+                logger.error("Couldn't create song of %s due to %s", job.path, ex)
+                failed(job_id, repr(ex))
+                continue
+            ids[id(song)] = job_id
+            songs.append(song)
+
+        def stage_failed(song: Song, stage: str, ex: Exception):
+            failed(ids.pop(id(song)), f"{stage}: {ex!r}", song)
+
+        for song in scheduler.run(songs, executor, failed=stage_failed):
+            job_id = ids.pop(id(song))
+            # Heartbeat learns about lost leases late, so it's renewed once more under
+            # the lock, which also keeps others from taking the job over while it's moved
+            if job_id not in heartbeat.job_ids or renew(spool, [job_id], node, lease):
+                logger.warning("Job %s was taken over, it's not saved", job_id)
+                heartbeat.job_ids.discard(job_id)
+                continue
+            try:
+                destination = finish(song)
+            except Exception as ex:
+                logger.error("Couldn't save `%s` due to %s", song.title, ex)
+                failed(job_id, repr(ex), song)
+                continue
+            done(job_id, song, destination)
+    except Exception as ex:
+        # Daemon keeps running, jobs of this batch which weren't finished are failed
+        logger.error("Couldn't process jobs due to %s", ex)
+        for job_id in ids.values():
+            failed(job_id, repr(ex))
+    finally:
+        heartbeat.stop()
+
+
+def serve(
+    spool: str,
+    create: Callable[[Path], Song],
+    finish: Callable[[Song], str],
+    executor: str = "thread",
+    poll: float = POLL,
+    batch: int = BATCH,
+    node: str = NODE,
+    lease: float = LEASE,
+):
+    """Processes jobs submitted to `spool` until interrupted"""
+    os.makedirs(spool, exist_ok=True)
+    logger.info("Node %s is waiting for jobs in %s", node, spool)
+    try:
+        while True:
+            claimed = claim(spool, batch, node, lease)
+            if not claimed:
+                time.sleep(poll)
+                continue
+            logger.info("Processing %s jobs", len(claimed))
+            process(spool, claimed, create, finish, executor, node, lease)
+    except KeyboardInterrupt:
+        logger.info("Daemon stopped")
+    finally:
+        registry.release()
+
+
+def status(spool: str) -> str:
+    """Table of jobs in `spool`, with number of jobs per status"""
+    lines = []
+    counts = {}
+    for job_id, job in jobs(spool).items():
+        counts[job.status] = counts.get(job.status, 0) + 1
+        seconds = f"{job.seconds:.1f}s" if job.seconds is not None else "-"
+        line = f"{job_id:<26} {job.status:<8} {seconds:>8} {job.node or '-':<20} {job.path}"
+        lines.append(line + (f" ({job.error})" if job.error else ""))
+    lines.append(", ".join(f"{count} {status}" for status, count in counts.items()))
+    return "\n".join(lines)
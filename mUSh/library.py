@@ -1,75 +1,255 @@
 import os
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import (
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
 from pathlib import Path
+from queue import SimpleQueue
 
 import msgspec
 
+from mUSh import separator
 from mUSh.cli import logger
-from mUSh.cover import fetch_cover
 from mUSh.song import Song
 
+INDEX_FILE = ".mUSh.index"
+"""Name of index file stored at library's root"""
+
 
 class LibrarySong(msgspec.Struct):
     folder: str
     playlist: str
-    song: Song
+    _song: Song = None
+    path: str = None
+    headers: dict = None
+    """Parsed headers, when read through library's index"""
 
+    @property
+    def song(self) -> Song:
+        """Song with headers only, unless library was read without index.
+        Built on first access"""
+        if self._song is None:
+            self._song = Song.from_headers(self.headers, self.path)
+        return self._song
 
-def iterate_songs(path: str):
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            if file.endswith(".txt"):
-                yield os.path.join(root, file)
+    def read(self) -> Song:
+        """Reads song again, notes are read once they are needed"""
+        return Song.read(self.path, lazy=True)
 
 
-def get_songs(path: str) -> list[LibrarySong]:
-    songs = []
-    for song_path in iterate_songs(path):
-        if song_path.endswith("license.txt"):
-            continue
-        folder = Path(song_path).parent
-        playlist = folder.parent
+class IndexEntry(msgspec.Struct, array_like=True):
+    mtime: int
+    size: int
+    headers: dict | None = None
+    error: str | None = None
+    """Reason why file couldn't be read"""
+
+
+class LibraryIndex(msgspec.Struct):
+    """Parsed headers of library's songs, keyed by their path relative to library's root"""
+
+    entries: dict[str, IndexEntry] = {}
+    version: int = 1
+
+    @classmethod
+    def load(cls, path: str) -> "LibraryIndex":
         try:
-            songs.append(LibrarySong(folder, playlist.name, Song.read(song_path)))
-        except (TypeError, msgspec.ValidationError) as ex:
-            logger.error("Couldn't read %s due to %s", song_path, ex)
-            continue
-    return songs
+            with open(os.path.join(path, INDEX_FILE), "rb") as file:
+                return msgspec.msgpack.decode(file.read(), type=cls)
+        except FileNotFoundError:
+            return cls()
+        except msgspec.DecodeError as ex:
+            logger.warning("Library index is invalid due to %s. Rebuilding.", ex)
+            return cls()
+
+    def save(self, path: str):
+        index_file = os.path.join(path, INDEX_FILE)
+        logger.debug("Saving library index with %s songs", len(self.entries))
+        with open(index_file + ".tmp", "wb") as file:
+            file.write(msgspec.msgpack.encode(self))
+        os.replace(index_file + ".tmp", index_file)
+
+    def lookup(self, key: str, stat: os.stat_result) -> IndexEntry | None:
+        """Entry of `key`, unless it's file was changed since last time"""
+        entry = self.entries.get(key)
+        if entry and entry.mtime == stat.st_mtime_ns and entry.size == stat.st_size:
+            return entry
 
 
-def list_library(path: str):
-    for element in get_songs(path):
-        logger.info(element.playlist, element.song.title)
+def iterate_songs(path: str):
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            if file.endswith(".txt"):
+                yield os.path.join(root, file)
 
 
-def add_missing_stems(path: str):
-    for element in get_songs(path):
+def _read(song_path: str, headers_only: bool) -> tuple[Song | dict | None, str | None]:
+    """Parses song at `song_path` in a worker. Returns song (or it's headers) and an error"""
+    try:
+        song = Song.read(song_path, lazy=headers_only)
+    except (TypeError, msgspec.ValidationError) as ex:
+        return None, str(ex)
+    return (song.headers() if headers_only else song), None
+
+
+def _executor(workers: int, executor: str) -> Executor | None:
+    if not workers:
+        return None
+    if executor == "thread":
+        return ThreadPoolExecutor(workers)
+    return ProcessPoolExecutor(workers)
+
+
+def scan_songs(
+    path: str,
+    use_index: bool = True,
+    workers: int = 0,
+    executor: str = "process",
+    ordered: bool = True,
+) -> Iterator[LibrarySong]:
+    """Yields songs of library at `path`. With `use_index`, only headers of songs are read,
+    and only of files that changed since previous run.
+
+    With `workers`, files are parsed by a pool of processes or threads (`executor`).
+    Songs are yielded in order of discovery if `ordered`, otherwise as soon as they are parsed.
+    Index is saved only once library was scanned whole"""
+    index = LibraryIndex.load(path) if use_index else None
+    entries = {}
+    root = len(os.path.join(path, ""))
+    pool = _executor(workers, executor)
+    pending = deque()
+    """Songs in order of discovery, when `ordered`"""
+    done = SimpleQueue()
+    """Parsed songs in order of completion, when not `ordered`"""
+    outstanding = 0
+
+    def finish(song_path: str, key: str, stat: os.stat_result, result):
+        if isinstance(result, Future):
+            result = result.result()
+        if index is not None and not isinstance(result, IndexEntry):
+            headers, error = result
+            result = IndexEntry(stat.st_mtime_ns, stat.st_size, headers, error)
+        if index is not None:
+            entries[key] = result
+            song, error = None, result.error
+        else:
+            song, error = result
+        if error:
+            logger.error("Couldn't read %s due to %s", song_path, error)
+            return
+        folder = os.path.dirname(song_path)
+        playlist = os.path.basename(os.path.dirname(folder))
+        if index is None:
+            return LibrarySong(folder, playlist, song, song_path)
+        return LibrarySong(folder, playlist, path=song_path, headers=result.headers)
+
+    def ready(wait: bool = False):
+        nonlocal outstanding
+        if ordered:
+            while pending and (
+                wait or not isinstance(pending[0][3], Future) or pending[0][3].done()
+            ):
+                if song := finish(*pending.popleft()):
+                    yield song
+            return
+        while outstanding and (wait or not done.empty()):
+            outstanding -= 1
+            if song := finish(*done.get()):
+                yield song
+
+    try:
+        for song_path in iterate_songs(path):
+            if song_path.endswith("license.txt"):
+                continue
+            key = song_path[root:]
+            stat = os.stat(song_path) if index is not None else None
+            result = index.lookup(key, stat) if index is not None else None
+            if result is None and pool:
+                result = pool.submit(_read, song_path, index is not None)
+            elif result is None:
+                result = _read(song_path, index is not None)
+            item = (song_path, key, stat, result)
+            if not ordered and not isinstance(result, Future):
+                if song := finish(*item):
+                    yield song
+                continue
+            if ordered:
+                pending.append(item)
+            else:
+                outstanding += 1
+                result.add_done_callback(lambda _, item=item: done.put(item))
+            yield from ready()
+        yield from ready(wait=True)
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+
+    if index is not None and entries != index.entries:
+        index.entries = entries
+        index.save(path)
+
+
+def get_songs(path: str, use_index: bool = True, **scan) -> list[LibrarySong]:
+    """Songs of library at `path`. See `scan_songs` for parameters"""
+    return list(scan_songs(path, use_index, **scan))
+
+
+def list_library(path: str, **scan):
+    for element in scan_songs(path, **scan):
+        logger.info("%s: %s", element.playlist, element.song.title)
+
+
+def add_missing_stems(path: str, **scan):
+    for element in scan_songs(path, ordered=False, **scan):
         if element.song.instrumental:
             logger.info("Instrumental stems already exists in %s", element.song.title)
             continue
         logger.info("Adding stems to %s", element.song.title)
         try:
-            element.song.separate_vocals()
-            element.song.write(element.song.get_path(""))
-            element.song.move(element.folder)
+            song = element.read()
+            song.separate_vocals()
+            song.write(song.get_path(""))
+            song.move(element.folder)
+            # Songs are handled one by one, so no other one is using them
+            separator.remove_lossless(song.stems_directory())
         except Exception as ex:
             logger.warning("Couldn't save %s due to %s", element.song.title, ex)
 
 
-def add_missing_covers(path: str):
-    for element in get_songs(path):
-        if element.song.cover:
-            logger.info("Cover already exists in %s", element.song.title)
-            continue
-        if add_cover(element.song):
-            element.song.write(element.song.get_path(""))
+def add_missing_covers(path: str, **scan):
+    # Imported only when covers are fetched, as it brings in requests
+    from mUSh.cover import fetch_covers
+
+    def missing():
+        for element in scan_songs(path, ordered=False, **scan):
+            if element.song.cover:
+                logger.info("Cover already exists in %s", element.song.title)
+                continue
+            yield element
+
+    def song(element: LibrarySong):
+        return element.song.artist, element.song.title, element.song.get_path("")
+
+    for element, out in fetch_covers(missing(), song):
+        if _set_cover(element.song, out):
+            element.song.patch_headers(element.path, cover=element.song.cover)
 
 
 def add_cover(song: Song):
-    if out := fetch_cover(song.artist, song.title, song.get_path("")):
+    from mUSh.cover import fetch_cover
+
+    return _set_cover(song, fetch_cover(song.artist, song.title, song.get_path("")))
+
+
+def _set_cover(song: Song, out: Path | None) -> bool:
+    if out:
         logger.info("Adding cover to %s", song.title)
         song.cover = out.name
         return True
     else:
         logger.info("Couldn't add cover to %s", song.title)
-
-
+        return False
@@ -0,0 +1,175 @@
+"""
+Wall & CPU time, peak memory and cache hits of each stage of a song.
+
+Stages are measured with `measure`, which stages running inside of it mark as read from cache
+with `cached`. Once song is finished, it's `Record` gets real-time factors from the length of
+the audio and is appended as a single JSON line to `OUTPUT`, if it's set.
+
+A single stage (`PROFILE`) can be wrapped with cProfile or tracemalloc,
+which output is stored in `PROFILE_DIR` and linked from the stage's measurement.
+Both are global to the process, so while one occurrence of the stage is profiled,
+others running alongside (of other songs) aren't.
+RSS is only sampled when records are written, as otherwise nothing reads it.
+"""
+
+import cProfile
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Iterator
+
+import msgspec
+
+from mUSh.cli import logger
+
+OUTPUT: str = None
+"""Path of JSON lines file records of songs are appended to. `None` to not write them"""
+PROFILE: str = None
+"""Name of stage (like `pitch` or `notes.merge_chars`) to profile"""
+PROFILER = "cprofile"
+"""Either `cprofile` (stats loadable by `pstats`) or `tracemalloc` (snapshot of allocations)"""
+PROFILE_DIR = "out/profiles"
+SAMPLE_INTERVAL = 0.05
+"""Seconds between samples of RSS while a stage runs"""
+
+_current = threading.local()
+_lock = threading.Lock()
+_profiling = threading.Lock()
+"""Held while a stage is profiled"""
+
+
+class Measurement(msgspec.Struct):
+    stage: str
+    seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    """CPU time of the thread running the stage. Threads started by libraries aren't counted"""
+    peak_rss: int = 0
+    """Peak resident memory of the process while stage ran, including stages running alongside.
+    `0` unless `OUTPUT` is set"""
+    cached: bool = False
+    """Whether result was read from cache instead of computed"""
+    batch: int = 1
+    """Songs stage ran for at once, which share this measurement"""
+    realtime_factor: float | None = None
+    """Seconds it took per second of audio"""
+    profile: str | None = None
+    """Path of profiler's output"""
+
+
+class Record(msgspec.Struct):
+    song: str
+    audio: str | None = None
+    started: float = msgspec.field(default_factory=time.time)
+    duration: float | None = None
+    """Length of the audio in seconds"""
+    seconds: float | None = None
+    """Time since record was created until song was finished"""
+    stages: list[Measurement] = []
+    error: str | None = None
+
+
+def rss() -> int:
+    """Current resident memory of the process in bytes, or it's peak where that's unavailable"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _Sampler(threading.Thread):
+    """Samples RSS until stopped"""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.peak = rss()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(SAMPLE_INTERVAL):
+            self.peak = max(self.peak, rss())
+
+    def stop(self) -> int:
+        self._stopped.set()
+        self.join()
+        return max(self.peak, rss())
+
+
+@contextmanager
+def measure(stage: str, record: Record = None) -> Iterator[Measurement]:
+    """Measures code within, appending measurement of `stage` to `record` if it's given"""
+    measurement = Measurement(stage)
+    previous = getattr(_current, "measurement", None)
+    _current.measurement = measurement
+    profiling = stage == PROFILE and _profiling.acquire(blocking=False)
+    if stage == PROFILE and not profiling:
+        logger.debug("%s is profiled already, not profiling it again", stage)
+    profiler = _start_profiler() if profiling else None
+    sampler = _Sampler() if OUTPUT else None
+    if sampler:
+        sampler.start()
+    started, cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield measurement
+    finally:
+        measurement.seconds = time.perf_counter() - started
+        measurement.cpu_seconds = time.thread_time() - cpu
+        if sampler:
+            measurement.peak_rss = sampler.stop()
+        if profiling:
+            try:
+                measurement.profile = _stop_profiler(profiler, stage)
+            finally:
+                _profiling.release()
+        _current.measurement = previous
+        if record is not None:
+            record.stages.append(measurement)
+
+
+def cached():
+    """Marks stage being measured in this thread as read from cache"""
+    if measurement := getattr(_current, "measurement", None):
+        measurement.cached = True
+
+
+def _start_profiler() -> cProfile.Profile | None:
+    if PROFILER == "tracemalloc":
+        tracemalloc.start()
+        return None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def _stop_profiler(profiler: cProfile.Profile | None, stage: str) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = os.path.join(PROFILE_DIR, f"{stage}_{os.getpid()}_{time.time_ns()}")
+    if PROFILER == "tracemalloc":
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        snapshot.dump(name + ".tracemalloc")
+        return name + ".tracemalloc"
+    profiler.disable()
+    profiler.dump_stats(name + ".prof")
+    return name + ".prof"
+
+
+def finish(record: Record):
+    """Sets real-time factors of stages from song's `duration`, then writes `record` to `OUTPUT`"""
+    record.seconds = time.time() - record.started
+    if record.duration:
+        for measurement in record.stages:
+            measurement.realtime_factor = measurement.seconds / record.duration
+    if OUTPUT:
+        write(OUTPUT, record)
+
+
+def write(path: str, record: Record):
+    """Appends `record` to JSON lines file at `path`"""
+    line = msgspec.json.encode(record) + b"\n"
+    logger.debug("Writing metrics of `%s` to %s", record.song, path)
+    with _lock, open(path, "ab") as file:
+        file.write(line)
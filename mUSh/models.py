@@ -21,7 +21,9 @@ class NoteTypes(Enum):
     PLAYER = "P"
 
 
-class Note(msgspec.Struct):
+class Note(msgspec.Struct, array_like=True):
+    """Encoded as an array, just like a line of .txt"""
+
     note_type: NoteTypes
     start_beat: int
     """If `note_type` is `PLAYER`, this field represents player number"""
@@ -84,7 +86,7 @@ class Song(msgspec.Struct):
 
     def __post_init__(self):
         self._handle_deprecated_fields()
-        if any(self.audio.endswith(x) for x in {"mp4", "avi", "webm"}):
+        if self.audio.endswith(("mp4", "avi", "webm")):
             self.video = self.audio
 
         if not self.title and not self.artist:
@@ -1,8 +1,12 @@
-import crepe
+import os
+from pathlib import Path
+from typing import Callable
+
 import msgspec
 import numpy as np
-from mUSh.separator import convert
-from scipy.io import wavfile
+from mUSh import crepe_onnx
+from mUSh.separator import convert, load_stem
+from numpy.lib.stride_tricks import sliding_window_view
 
 
 class Pitch(msgspec.Struct):
@@ -11,14 +15,246 @@ class Pitch(msgspec.Struct):
     confidence: float
 
 
-def detect_pitch(path: str):
-    result = convert(path, "vocals.mp3", extension="wav")
-    sr, audio = wavfile.read(path / result)
-    times, frequencies, confidences, _ = crepe.predict(audio, sr, viterbi=True)
+SAMPLE_RATE = 16000
+"""Rate vocals are analyzed at. Audio at other rates is resampled first"""
+CHUNK_OVERLAP = 1.0
+"""Seconds of context around chunks of `detect_pitch`"""
+PITCH_DTYPE = np.dtype([("time", "f8"), ("freq", "f4"), ("confidence", "f4")])
+"""Frames of `detect_pitch`. Time is kept in double precision,
+as it's matched against character timestamps"""
+
+
+def predict_crepe(
+    audio: np.ndarray,
+    sr: int,
+    step_size: int = 10,
+    model_capacity: str = "full",
+    viterbi: bool = True,
+):
+    # Imported here, as it loads TensorFlow, which other engines don't need
+    import crepe
+
+    times, frequencies, confidences, _ = crepe.predict(
+        audio, sr, model_capacity=model_capacity, viterbi=viterbi, step_size=step_size
+    )
+    return times, frequencies, confidences
+
+
+def predict_yin(
+    audio: np.ndarray,
+    sr: int,
+    step_size: int = 10,
+    fmin: float = 65.0,
+    fmax: float = 1000.0,
+    threshold: float = 0.15,
+    block: int = 1024,
+    **_,
+):
+    """YIN, vectorized over `block` frames at once. Frames are centered like crepe's.
+    Confidence is one minus aperiodicity of chosen period"""
+    audio = np.asarray(audio, dtype=np.float64)
+    if audio.ndim == 2:
+        audio = audio.mean(axis=1)
+    hop = int(sr * step_size / 1000)
+    min_period, max_period = max(int(sr / fmax), 2), int(np.ceil(sr / fmin))
+    window = max_period
+    length = window + max_period + 1
+    size = 1 << int(np.ceil(np.log2(length + window)))
+    count = 1 + len(audio) // hop
+    padded = np.pad(audio, (length // 2, length // 2 + hop))
+    frames = sliding_window_view(padded, length)[::hop][:count]
+    taus = np.arange(max_period + 1)
+
+    frequencies = np.empty(count)
+    confidences = np.empty(count)
+    for first in range(0, count, block):
+        chunk = frames[first : first + block]
+        # Correlation of window with itself shifted by each period, through FFT
+        spectrum = np.fft.rfft(chunk, size)
+        spectrum *= np.conj(np.fft.rfft(chunk[:, :window], size))
+        correlation = np.fft.irfft(spectrum, size)[:, : max_period + 1]
+        energy = np.cumsum(np.square(chunk), axis=1)
+        energy = np.concatenate((np.zeros((len(chunk), 1)), energy), axis=1)
+        shifted = energy[:, taus + window] - energy[:, taus]
+        difference = shifted[:, :1] + shifted - 2 * correlation
+        np.maximum(difference, 0, out=difference)
+
+        # Cumulative mean normalized difference
+        cumulative = np.cumsum(difference[:, 1:], axis=1)
+        normalized = np.ones_like(difference)
+        normalized[:, 1:] = difference[:, 1:] * taus[1:] / np.maximum(cumulative, 1e-12)
+
+        # First local minimum below threshold, otherwise global minimum
+        candidates = normalized[:, min_period:max_period]
+        minimum = candidates[:, :-1] <= candidates[:, 1:]
+        below = (candidates[:, :-1] < threshold) & minimum
+        tau = np.where(
+            below.any(axis=1),
+            below.argmax(axis=1),
+            candidates.argmin(axis=1).clip(max=candidates.shape[1] - 2),
+        )
+        tau = np.maximum(tau + min_period, 1)
+
+        # Parabolic interpolation between neighbouring periods
+        rows = np.arange(len(chunk))
+        a, b, c = (normalized[rows, tau + i] for i in (-1, 0, 1))
+        curvature = a - 2 * b + c
+        shift = np.divide(
+            a - c, 2 * curvature, out=np.zeros_like(a), where=curvature > 0
+        )
+        period = tau + np.clip(shift, -1, 1)
+
+        frequencies[first : first + block] = sr / period
+        confidences[first : first + block] = np.clip(1 - b, 0, 1)
+    return np.arange(count) * step_size / 1000, frequencies, confidences
+
+
+class Engine(msgspec.Struct):
+    predict: Callable
+    """Returns times, frequencies and confidences of frames of mono audio"""
+    resource: str
+    """What it's heavy on, see `StageConfig.resource`"""
+
+
+ENGINES = {
+    "crepe": Engine(predict_crepe, "accelerator"),
+    "yin": Engine(predict_yin, "cpu"),
+    "crepe-onnx": Engine(crepe_onnx.predict, "cpu"),
+}
+
+
+def detect_pitch(
+    path: str,
+    model_capacity: str = "full",
+    viterbi: bool = True,
+    step_size: int = 10,
+    activity: np.ndarray = None,
+    engine: str = "crepe",
+    chunk: float = None,
+    output: str | Path = None,
+):
+    """Pitch of vocals separated into `path`, detected by `engine`.
+    If vocal `activity` regions are given, only those are analyzed.
+    With `chunk` (in seconds), vocals are read memory mapped and analyzed chunk by chunk,
+    so memory use doesn't depend on length of the track.
+    If `output` is set, frames are written there as they are detected and returned memory mapped
+    """
+    from scipy.io import wavfile
+    from scipy.signal import resample_poly
+
+    wav = None
+    if not os.path.exists(Path(path) / "vocals.npy"):
+        wav = Path(path) / convert(path, "vocals.mp3", extension="wav")
+
+    def load() -> tuple[int, np.ndarray]:
+        # When chunked, samples are memory mapped again for each chunk,
+        # so pages of previous ones are unmapped
+        if wav:
+            sr, samples = wavfile.read(wav, mmap=bool(chunk))
+            return sr, np.atleast_2d(samples.T)
+        vocals = load_stem(path, "vocals")
+        if chunk:
+            return vocals.samplerate, vocals.get()
+        return SAMPLE_RATE, vocals.get(SAMPLE_RATE, mono=True)[None]
+
+    rate, samples = load()
+    step = step_size / 1000
+    count = 1 + int(samples.shape[-1] / rate / step)
+    if output:
+        result = np.lib.format.open_memmap(
+            f"{output}.tmp", mode="w+", dtype=PITCH_DTYPE, shape=(count,)
+        )
+    else:
+        result = np.zeros(count, dtype=PITCH_DTYPE)
+
+    def predict(first: int, last: int):
+        # Mono samples of frames from `first` until `last`
+        sr, audio = load() if chunk else (rate, samples)
+        start, end = round(first * step * sr), round(last * step * sr)
+        up, down = SAMPLE_RATE, sr
+        before = after = 0
+        if sr != SAMPLE_RATE:
+            gcd = np.gcd(sr, SAMPLE_RATE)
+            up, down = SAMPLE_RATE // gcd, sr // gcd
+            # Resampled with samples around, as many as filter of `resample_poly` reaches
+            # and rounded to whole output samples, so edges match resampling whole track
+            context = down * -(-(10 * max(up, down) // up + 1) // down)
+            before, after = min(context, start), context
+        length = min(end, audio.shape[-1]) - start
+        audio = audio[:, start - before : end + after].astype(np.float32).mean(axis=0)
+        if sr != SAMPLE_RATE:
+            audio = resample_poly(audio, up, down)
+            skip = before * up // down
+            audio = audio[skip : skip + -(-length * up // down)]
+        _, frequencies, confidences = ENGINES[engine].predict(
+            audio,
+            SAMPLE_RATE,
+            step_size=step_size,
+            model_capacity=model_capacity,
+            viterbi=viterbi,
+        )
+        return frequencies[: last - first], confidences[: last - first]
+
+    try:
+        pieces = _pieces(activity, step, count) if activity is not None else []
+        size = int(chunk / step) if chunk else count
+        for first in range(0, count, size):
+            result["time"][first : first + size] = (
+                np.arange(first, min(first + size, count)) * step
+            )
+        _predict_pieces(
+            predict, pieces or [(0, count)], size, int(CHUNK_OVERLAP / step), result
+        )
+    except BaseException:
+        if output:
+            # Partial frames aren't left behind
+            del result
+            os.remove(f"{output}.tmp")
+        raise
+
+    if output:
+        result.flush()
+        del result
+        os.replace(f"{output}.tmp", output)
+        return np.load(output, mmap_mode="r")
+    return result
+
+
+def _pieces(activity: np.ndarray, step: float, count: int) -> list[tuple[int, int]]:
+    """Ranges of frames within `activity` regions"""
+    pieces = []
+    for start, end in activity:
+        first, last = int(start / step), min(int(np.ceil(end / step)) + 1, count)
+        if first < last:
+            pieces.append((first, last))
+    return pieces
+
+
+def _predict_pieces(
+    predict: Callable,
+    pieces: list[tuple[int, int]],
+    size: int,
+    overlap: int,
+    result: np.ndarray,
+):
+    """Predicts frames of each piece in chunks of `size` frames into `result`.
+    Chunks are predicted with `overlap` frames of context within the piece on both sides,
+    which are then dropped, so Viterbi paths continue across chunks like in a single pass.
+    Frames between pieces take note of following (or last) predicted frame, with no confidence
+    """
+    for first, last in pieces:
+        for start in range(first, last, size):
+            end = min(start + size, last)
+            context = max(start - overlap, first)
+            frequencies, confidences = predict(context, min(end + overlap, last))
+            kept = slice(start - context, end - context)
+            notes = 12 * (np.log2(frequencies[kept]) - np.log2(440.0)) + (69 - 48)
+            result["freq"][start:end] = notes
+            result["confidence"][start:end] = confidences[kept]
 
-    notes = 12 * (np.log2(np.asanyarray(frequencies)) - np.log2(440.0)) + (69 - 48)
-    return {
-        "time": [float(t) for t in times],
-        "freq": [float(n) for n in notes],
-        "confidence": [float(c) for c in confidences],
-    }
+    following = [start for start, _ in pieces[1:]] + [len(result)]
+    for (_, end), start in zip(pieces, following):
+        result["freq"][end:start] = result["freq"][
+            start if start < len(result) else end - 1
+        ]
+    result["freq"][: pieces[0][0]] = result["freq"][pieces[0][0]]
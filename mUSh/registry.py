@@ -0,0 +1,64 @@
+"""
+Models loaded once per process and reused by every song.
+
+Each registry keys models by whatever alters them (name, device, compute type, language),
+keeping the recently used ones when it's `capacity` is exceeded.
+"""
+
+import gc
+import sys
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+from mUSh.cli import logger
+
+
+class Registry:
+    def __init__(self, name: str, capacity: int = None):
+        self.name = name
+        self.capacity = capacity
+        """Maximum number of models kept loaded. `None` for unlimited"""
+        self._models: OrderedDict[Hashable, object] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, load: Callable[[], object]):
+        """Model stored under `key`, loaded with `load` if it's not loaded yet"""
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+            logger.debug("Loading %s model %s", self.name, key)
+            self._models[key] = model = load()
+            if self.capacity and len(self._models) > self.capacity:
+                evicted, _ = self._models.popitem(last=False)
+                logger.debug("Evicting %s model %s", self.name, evicted)
+                _free_memory()
+            return model
+
+    def release(self, key: Hashable = None):
+        """Unloads model stored under `key`, or all of them"""
+        with self._lock:
+            if key is None:
+                self._models.clear()
+            else:
+                self._models.pop(key, None)
+        _free_memory()
+
+
+def _free_memory():
+    gc.collect()
+    if (torch := sys.modules.get("torch")) and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+TRANSCRIBERS = Registry("transcription")
+ALIGNERS = Registry("alignment", capacity=2)
+SEPARATORS = Registry("separation")
+PITCH = Registry("pitch")
+
+
+def release():
+    """Unloads all models"""
+    for registry in (TRANSCRIBERS, ALIGNERS, SEPARATORS, PITCH):
+        registry.release()
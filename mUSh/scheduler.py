@@ -0,0 +1,186 @@
+"""
+Runs stages of songs concurrently, following dependencies declared by `STAGES`.
+
+Each resource (`cpu`, `accelerator`) has it's own pool of workers. Whenever one is free,
+it takes a ready stage of the earliest song, so independent stages of a song overlap,
+and next song starts separating while previous one is transcribed.
+Stages with a `batch_method` take the same stage of next ready songs along with it
+(up to `batch` of them), like separation passing several short songs to the model at once.
+"""
+
+import os
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from typing import Callable, Iterable, Iterator
+
+import msgspec
+
+from mUSh import metrics, separator
+from mUSh.cli import logger
+from mUSh.song import STAGES, Song
+
+WORKERS = {"cpu": os.cpu_count() or 1, "accelerator": 2}
+"""Default number of workers per resource"""
+
+
+def _changed(song: Song, before: dict) -> dict:
+    return {
+        field: value
+        for field, value in msgspec.structs.asdict(song).items()
+        if value is not before[field]
+    }
+
+
+def run_stage(song: Song, stage: str) -> tuple[dict, metrics.Measurement]:
+    """Runs `stage` of `song`. Returns fields it changed,
+    as song is only a copy when running in another process, and it's measurement"""
+    before = msgspec.structs.asdict(song)
+    with metrics.measure(stage) as measurement:
+        getattr(song, STAGES[stage].method)()
+    return _changed(song, before), measurement
+
+
+def run_batch(songs: list[Song], stage: str) -> list[tuple[dict, metrics.Measurement]]:
+    """Runs `stage` of `songs` at once, like `run_stage`. Each song gets a copy of
+    the measurement of whole batch"""
+    before = [msgspec.structs.asdict(song) for song in songs]
+    with metrics.measure(stage) as measurement:
+        getattr(Song, STAGES[stage].batch_method)(songs)
+    measurement.batch = len(songs)
+    return [
+        (_changed(song, fields), msgspec.structs.replace(measurement))
+        for song, fields in zip(songs, before)
+    ]
+
+
+def _remove_lossless(songs: list[Song], failures: set[int]):
+    """Removes float32 stems of finished songs, which are only needed until notes are built.
+    Songs with the same audio share them, so ones shared with a failed song are kept for retry
+    """
+    kept = {songs[index]._cache for index in failures}
+    for index, song in enumerate(songs):
+        if index not in failures and song._cache and song._cache not in kept:
+            separator.remove_lossless(song._cache)
+
+
+def run(
+    songs: Iterable[Song],
+    executor: str = "thread",
+    workers: dict[str, int] = None,
+    failed: Callable[[Song, str, Exception], None] = None,
+) -> Iterator[Song]:
+    """Runs all stages of `songs` using pools of threads or processes (`executor`).
+    Yields songs with notes built, in order they finish.
+    Songs which stage failed are logged, passed to `failed` along with the stage
+    & exception, and skipped. Each song's stages are measured into it's `metrics.Record`
+    """
+    songs = list(songs)
+    for song in songs:
+        song._metrics = metrics.Record(f"{song.artist} - {song.title}", song.audio)
+        song._share_audio = executor == "process"
+    workers = WORKERS | (workers or {})
+    pool = ProcessPoolExecutor if executor == "process" else ThreadPoolExecutor
+    pools = {resource: pool(count) for resource, count in workers.items()}
+    busy = dict.fromkeys(workers, 0)
+    pending = [set(STAGES) for _ in songs]
+    """Stages not submitted yet"""
+    unfinished = [set(STAGES) for _ in songs]
+    failures = set()
+    running: dict[Future, tuple[list[int], str]] = {}
+
+    def ready(index: int, stage: str) -> bool:
+        return stage in pending[index] and STAGES[stage].source not in unfinished[index]
+
+    def schedule():
+        for index, stages in enumerate(pending):
+            for stage in [s for s in STAGES if s in stages]:
+                config = STAGES[stage]
+                if not ready(index, stage):
+                    continue
+                if busy[config.resource] >= workers[config.resource]:
+                    continue
+                batch = [index]
+                if config.batch_method:
+                    batch += [
+                        other
+                        for other in range(index + 1, len(songs))
+                        if ready(other, stage)
+                    ][: config.batch - 1]
+                for member in batch:
+                    logger.debug("Starting %s of `%s`", stage, songs[member].title)
+                    pending[member].discard(stage)
+                busy[config.resource] += 1
+                if len(batch) > 1:
+                    future = pools[config.resource].submit(
+                        run_batch, [songs[member] for member in batch], stage
+                    )
+                else:
+                    future = pools[config.resource].submit(
+                        run_stage, songs[index], stage
+                    )
+                running[future] = (batch, stage)
+
+    def finished(
+        index: int, stage: str, result: tuple[dict, metrics.Measurement] | Exception
+    ) -> Iterator[Song]:
+        """Applies `result` of `stage`, yielding song once all of it's stages finished"""
+        song = songs[index]
+        unfinished[index].discard(stage)
+        if isinstance(result, Exception):
+            logger.error("Couldn't run %s of `%s` due to %s", stage, song.title, result)
+            pending[index].clear()
+            if index not in failures:
+                song._metrics.error = f"{stage}: {result!r}"
+                metrics.finish(song._metrics)
+                if failed:
+                    failed(song, stage, result)
+            failures.add(index)
+            if not any(index in batch for batch, _ in running.values()):
+                # Once none of it's stages is running anymore
+                song.release_audio()
+        else:
+            changed, measurement = result
+            for field, value in changed.items():
+                setattr(song, field, value)
+            song._metrics.stages.append(measurement)
+        if unfinished[index] or index in failures:
+            return
+        try:
+            with metrics.measure("notes", song._metrics):
+                song.build_notes()
+        except Exception as ex:
+            logger.error("Couldn't build notes of `%s` due to %s", song.title, ex)
+            song._metrics.error = f"notes: {ex!r}"
+            song.release_audio()
+            metrics.finish(song._metrics)
+            if failed:
+                failed(song, "notes", ex)
+            return
+        metrics.finish(song._metrics)
+        yield song
+
+    try:
+        schedule()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch, stage = running.pop(future)
+                busy[STAGES[stage].resource] -= 1
+                try:
+                    results = future.result()
+                    if len(batch) == 1:
+                        results = [results]
+                except Exception as ex:
+                    results = [ex] * len(batch)
+                for index, result in zip(batch, results):
+                    yield from finished(index, stage, result)
+            schedule()
+        _remove_lossless(songs, failures)
+    finally:
+        for resource in pools.values():
+            resource.shutdown(cancel_futures=True)
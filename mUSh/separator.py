@@ -1,43 +1,227 @@
 import os
+import threading
+from contextlib import ExitStack
 from pathlib import Path
 
-import demucs.separate
-import ffmpeg
+import numpy as np
+from mUSh import cache, metrics, registry
+from mUSh.audio_source import SAMPLE_RATE, AudioSource
 from mUSh.cli import logger
 
 REUSE_OK = True
+BATCH_SECONDS = 240.0
+"""Longest track separated along with others, see `batches`"""
+BATCH_RATIO = 1.25
+"""How much longer than the shortest one tracks of a batch can be"""
+_lock = threading.Lock()
 
 
-def separate(path: str, model: str = "htdemucs_ft", output: str = "out") -> Path:
-    result = Path(output) / model / os.path.splitext(Path(path).name)[0]
-    if os.path.exists(result):
-        if os.path.exists(result / "no_vocals.mp3") and os.path.exists(
-            result / "vocals.mp3"
-        ):
+def load_model(model: str):
+    from demucs.pretrained import get_model
+
+    separation = get_model(model)
+    separation.cpu()
+    separation.eval()
+    return separation
+
+
+def separate(
+    path: str | AudioSource,
+    model: str = "htdemucs_ft",
+    output: str = "out",
+    name: str = None,
+    lossless: bool = False,
+) -> Path:
+    """Separates `path` into `vocals.mp3` and `no_vocals.mp3` stored in `output/model/name`.
+    `name` defaults to file name of `path`. Model is kept loaded for next songs.
+    While separated, stems are locked, so others separating the same wait and reuse them.
+    Audio is decoded through `AudioSource`, so an already decoded one can be passed.
+    If `lossless`, stems are stored as float32 `vocals.npy` and `no_vocals.npy` instead
+    """
+    return separate_many([path], model, output, [name], lossless)[0]
+
+
+def separate_many(
+    paths: list[str | AudioSource],
+    model: str = "htdemucs_ft",
+    output: str = "out",
+    names: list[str] = None,
+    lossless: bool = False,
+) -> list[Path]:
+    """Same as `separate`, with tracks passed to model at once.
+    Shorter tracks are padded to the longest, best used for tracks of similar length"""
+    extension = "npy" if lossless else "mp3"
+    results, tracks = [], []
+    for source, name in zip(paths, names or [None] * len(paths)):
+        if not isinstance(source, AudioSource):
+            source = AudioSource(source)
+        if not name:
+            name = os.path.splitext(Path(source.path).name)[0]
+        result = Path(output) / model / name
+        results.append(result)
+        if separated(result, extension):
             logger.debug("Stems already exists, skipping")
-            return result
-    demucs.separate.main(
-        ["--mp3", "--two-stems", "vocals", "-n", model, "--out", output, path]
+            metrics.cached()
+            continue
+        tracks.append((source, result))
+    if not tracks:
+        return results
+    with ExitStack() as stack:
+        # In the same order everywhere, so batches sharing tracks don't deadlock
+        for result in sorted({result for _, result in tracks}):
+            stack.enter_context(cache.locked(f"{result}.lock"))
+        # Others might have separated some while waiting for their locks
+        tracks = [(s, r) for s, r in tracks if not separated(r, extension)]
+        if not tracks:
+            logger.debug("Stems were separated meanwhile, skipping")
+            metrics.cached()
+            return results
+        _separate(tracks, model, lossless)
+    return results
+
+
+def batches(durations: list[float]) -> list[list[int]]:
+    """Indices of tracks grouped into batches for `separate_many`.
+    As tracks are padded to the longest one of their batch, only short tracks
+    of similar length are grouped, while long ones are separated alone"""
+    groups = []
+    for index in sorted(range(len(durations)), key=durations.__getitem__):
+        duration = durations[index]
+        if (
+            groups
+            and duration <= BATCH_SECONDS
+            and duration <= durations[groups[-1][0]] * BATCH_RATIO
+        ):
+            groups[-1].append(index)
+        else:
+            groups.append([index])
+    return groups
+
+
+def remove_lossless(path: str | Path):
+    """Removes float32 stems within `path`, once they were converted"""
+    for stem in ("vocals", "no_vocals"):
+        if os.path.exists(stem_file := Path(path) / f"{stem}.npy"):
+            logger.debug("Removing lossless stem %s", stem_file)
+            os.remove(stem_file)
+
+
+def separated(result: Path, extension: str) -> bool:
+    """Whether both stems were separated into `result` already"""
+    return os.path.exists(result / f"no_vocals.{extension}") and os.path.exists(
+        result / f"vocals.{extension}"
     )
-    return result
+
+
+def _separate(tracks: list[tuple[AudioSource, Path]], model: str, lossless: bool):
+    # torch & demucs are imported only once something has to be separated
+    import torch
+    from demucs.apply import apply_model
+    from demucs.audio import save_audio
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    separation = registry.SEPARATORS.get((model, device), lambda: load_model(model))
+
+    # Same steps as `demucs.separate.main` with `--mp3 --two-stems vocals`
+    wavs, refs = [], []
+    for source, _ in tracks:
+        wav = torch.from_numpy(np.array(source.get(separation.samplerate)))
+        ref = wav.mean(0)
+        wav -= ref.mean()
+        wav /= ref.std()
+        wavs.append(wav)
+        refs.append(ref)
+    length = max(wav.shape[-1] for wav in wavs)
+    mix = torch.stack(
+        [torch.nn.functional.pad(wav, (0, length - wav.shape[-1])) for wav in wavs]
+    )
+    with _lock:
+        # Bags of models move each model to device and back, so they can't be shared
+        batch = apply_model(separation, mix, device=device)
+
+    vocals_index = separation.sources.index("vocals")
+    for (_, result), wav, ref, sources in zip(tracks, wavs, refs, batch):
+        sources = sources[..., : wav.shape[-1]]
+        sources *= ref.std()
+        sources += ref.mean()
+
+        sources = list(sources)
+        vocals = sources.pop(vocals_index)
+        no_vocals = torch.zeros_like(sources[0])
+        for source in sources:
+            no_vocals += source
+        result.mkdir(parents=True, exist_ok=True)
+        extension = "npy" if lossless else "mp3"
+        for stem, audio in (("vocals", vocals), ("no_vocals", no_vocals)):
+            # Renamed once written, as format is taken from file's extension
+            partial = result / f"{stem}.tmp.{extension}"
+            if lossless:
+                np.save(partial, audio.numpy().astype(np.float32))
+            else:
+                save_audio(
+                    audio,
+                    str(partial),
+                    samplerate=separation.samplerate,
+                    bitrate=320,
+                    preset=2,
+                    clip="rescale",
+                    as_float=False,
+                    bits_per_sample=16,
+                )
+            os.replace(partial, result / f"{stem}.{extension}")
+
+
+def load_stem(path: str | Path, stem: str = "vocals") -> AudioSource | None:
+    """Memory mapped `stem`, if it was separated losslessly"""
+    try:
+        samples = np.load(Path(path) / f"{stem}.npy", mmap_mode="r")
+    except FileNotFoundError:
+        return None
+    return AudioSource(samples=samples)
 
 
 def convert(
-    path: str | Path, stem: str = "no_vocals.mp3", extension: str = "ogg"
+    path: str | Path,
+    stem: str = "no_vocals.mp3",
+    extension: str = "ogg",
+    name: str = None,
 ) -> str:
+    """Converts `stem` within `path` to `{name} [STEM TYPE].{extension}`.
+    `name` defaults to directory name"""
     path = Path(path)
-    if stem == "no_vocals.mp3":
+    if stem.startswith("no_vocals"):
         stem_type = "INSTRUMENTAL"
     else:
         stem_type = "VOCALS"
-    result = f"{path.name} [{stem_type}].{extension}"
-    if os.path.exists(path / result):
-        if REUSE_OK:
-            logger.debug("Reusing previous result")
-            return result
-        logger.debug("Deleting old result file")
-        os.remove(path / result)
-    worker = ffmpeg.FFmpeg().input(path / stem).output(path / result)
-    logger.debug("Calling FFmpeg with: %s", worker.arguments)
-    worker.execute()
+    result = f"{name or path.name} [{stem_type}].{extension}"
+    if os.path.exists(path / result) and REUSE_OK:
+        logger.debug("Reusing previous result")
+        return result
+    with cache.locked(path / f"{result}.lock"):
+        if os.path.exists(path / result):
+            if REUSE_OK:
+                logger.debug("Reusing result converted meanwhile")
+                return result
+            logger.debug("Deleting old result file")
+            os.remove(path / result)
+        _convert(path / stem, path / result, extension)
     return result
+
+
+def _convert(stem: Path, result: Path, extension: str):
+    import ffmpeg
+
+    worker, stream = ffmpeg.FFmpeg(), None
+    if stem.suffix == ".npy":
+        # Encoded straight from float samples, without intermediate lossy file
+        audio = np.load(stem, mmap_mode="r")
+        stream = np.ascontiguousarray(audio.T).tobytes()
+        worker = worker.input("pipe:0", f="f32le", ar=SAMPLE_RATE, ac=audio.shape[0])
+    else:
+        worker = worker.input(stem)
+    # Renamed once converted, as format is taken from file's extension
+    partial = result.with_name(f"{result.name}.tmp.{extension}")
+    worker = worker.output(partial)
+    logger.debug("Calling FFmpeg with: %s", worker.arguments)
+    worker.execute(stream)
+    os.replace(partial, result)
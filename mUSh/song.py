@@ -1,84 +1,150 @@
-import json
+import codecs
 import os
 from pathlib import Path
 import shutil
+from typing import Callable
 
 import msgspec
+import numpy as np
+from mUSh import activity
 from mUSh import pitcher
 from mUSh import separator
 from mUSh import transcriber
 from mUSh import bpm
-from mUSh import audio_notes
+from mUSh import cache
+from mUSh import codec
+from mUSh import metrics
+from mUSh.audio_source import AudioSource
 from mUSh.cli import logger
 from mUSh.models import Note, NoteTypes, Song as SongSchema
 
 OUTPUT_DIR = "out"
 HTDEMUCS_MODEL = "htdemucs_ft"
 DRY_RUN = False
+_CURRENT_DIRECTORY = Path(".")
+
+
+class StageConfig(msgspec.Struct):
+    source: str | None
+    """Stage which result is an input of this one. `None` if it's the original audio"""
+    model: str
+    options: dict = {}
+    """Parameters passed to the stage, which also alter its result"""
+    method: str = None
+    """Method of `Song` running this stage"""
+    batch_method: str = None
+    """Static method of `Song` running this stage for several songs at once"""
+    batch: int = 1
+    """Most songs passed to `batch_method` at once"""
+    resource: str = "cpu"
+    """What the stage is heavy on, either `cpu` or `accelerator`"""
+
+
+STAGES = {
+    "separation": StageConfig(
+        None,
+        HTDEMUCS_MODEL,
+        {"lossless": True},
+        method="separate_vocals",
+        batch_method="separate_many",
+        batch=4,
+        resource="accelerator",
+    ),
+    "activity": StageConfig(
+        "separation",
+        "rms",
+        {"threshold": -40.0, "min_silence": 0.3, "padding": 0.2},
+        method="detect_activity",
+    ),
+    "transcription": StageConfig(
+        "activity",
+        "large-v3",
+        {"compute_type": "int8", "batch_size": 4, "character_level": True},
+        method="transcribe_vocals",
+        resource="accelerator",
+    ),
+    "pitch": StageConfig(
+        "activity",
+        "full",
+        {"viterbi": True, "step_size": 10, "engine": "crepe"},
+        method="pitch_vocals",
+        resource="accelerator",
+    ),
+    "bpm": StageConfig(None, "librosa.beat_track", method="analyze_bpm"),
+}
+
+
+def _header_line(attribute: str, value, newline: bytes) -> bytes:
+    if value is None:
+        return b""
+    return codec.encode_header(attribute, value).encode()[:-1] + newline
 
 
 class FileOperations(SongSchema):
     _cache: Path = None
+    _cache_source: str = None
+    """Audio file `_cache` holds stems of"""
+    _source: str = None
+    """.txt file which notes weren't read from yet"""
+    _notes_offset: int = 0
 
     @classmethod
     def parse(cls, text: str) -> "Song":
         """Reads .txt file and parses it's structure"""
-        data = {"notes": []}
-        if not text.startswith("#"):
-            raise TypeError("Not a valid .txt file")
-        for line in text.splitlines():
-            if line == "E":
-                continue
-            elif line.startswith("#"):
-                line = line.strip()
-                key, value = line.split(":", 1)
-                if (
-                    value
-                    and value[0].isdigit()
-                    or len(value) > 1
-                    and value[1].isdigit()
-                ):
-                    value = value.replace(",", ".")
-                data[key.strip("#").lower()] = value
-            else:
-                note = dict(
-                    zip(Note.__annotations__, [i for i in line.split(" ", 4) if i])
-                )
-                data["notes"].append(msgspec.convert(note, Note, strict=False))
+        return msgspec.convert(codec.decode(text), cls, strict=False)
 
-        return msgspec.convert(data, cls, strict=False)
+    @classmethod
+    def from_headers(cls, headers: dict, path: str) -> "Song":
+        """Song of .txt at `path` out of it's already parsed headers, without notes"""
+        r = msgspec.convert(headers, cls, strict=False)
+        r._source = path
+        if r._path == _CURRENT_DIRECTORY:
+            r._path = Path(path).parent
+        return r
 
     @classmethod
-    def read(cls, path: str) -> "Song":
+    def read(cls, path: str, lazy: bool = False) -> "Song":
+        """Reads song from .txt at `path`. If `lazy`, only headers are read,
+        notes are read once they are needed (see `load_notes`)"""
         logger.info("Reading %s", path)
+        if lazy:
+            with open(path, "rb") as file:
+                headers, offset = codec.decode_headers(file)
+            r = cls.from_headers(headers, path)
+            r._notes_offset = offset
+            return r
         with open(path, "r", encoding="utf-8-sig", errors="ignore") as file:
             r = cls.parse(file.read())
             if r._path == Path("."):
                 r._path = Path(path).parent  # / Path(path).name.split(".")[0]
             return r
 
+    def load_notes(self) -> list[Note] | None:
+        """Reads notes which reading was deferred, if any. Returns `notes`"""
+        if self.notes is None and self._source:
+            logger.debug("Reading notes of %s", self._source)
+            with open(self._source, "rb") as file:
+                file.seek(self._notes_offset)
+                text = file.read().decode("utf-8-sig", errors="ignore")
+            data = codec.decode_lines(text.splitlines(), {"notes": []})
+            self.notes = msgspec.convert(data["notes"], list[Note], strict=False)
+            self._source = None
+        return self.notes
+
+    def headers(self) -> dict:
+        """Header fields which are set"""
+        return {
+            attribute: value
+            for attribute in codec.HEADERS
+            if (value := getattr(self, attribute)) is not None
+        }
+
     def dump(self) -> str:
         """Dumps structure into a text form"""
-        if not self.notes:
+        if not self.load_notes():
             self.build_notes()
         logger.debug("Dumping song `%s` data to Ultrastar text", self.title)
-        text = ""
-        for attribute in super().__annotations__:
-            if attribute.startswith("_"):
-                continue
-            if attribute != "notes":
-                if not (value := getattr(self, attribute)):
-                    continue
-                if super().__annotations__[attribute] is float:
-                    text += f"#{attribute.upper()}:{value:.2f}\n"
-                else:
-                    text += f"#{attribute.upper()}:{value}\n"
-
-        for note in self.notes:
-            text += str(note) + "\n"
-
-        text += "E"
-        return text
+        return codec.encode(self)
 
     def write(self, path: str, text: str = None):
         if not text:
@@ -94,28 +160,82 @@ class FileOperations(SongSchema):
             encoding="utf-8",
         ) as file:
             if not DRY_RUN:
-                file.writelines(text)
-
-    def cache_result(self, path: str, data, key: str):
-        logger.debug("Caching result %s to %s", key, path)
-
-        os.makedirs(path / "cache", exist_ok=True)
+                file.write(text)
+
+    def patch_headers(self, path: str, **headers):
+        """Sets `headers` and replaces their lines in .txt at `path`, leaving notes intact.
+        Headers set to `None` are removed, new ones are added at the end of headers"""
+        for attribute, value in headers.items():
+            setattr(self, attribute, value)
+        logger.debug("Patching headers %s of %s", ", ".join(headers), path)
+        if DRY_RUN:
+            return
 
-        with open(
-            path / f"cache/{key}_{self.title}.json", "w", newline="", encoding="utf-8"
-        ) as file:
-            json.dump(msgspec.to_builtins(data), file)
-
-    def read_cache(self, path: str, key: str):
-        cached_file = self._cache / f"cache/{key}_{self.title}.json"
-        if os.path.exists(cached_file):
-            logger.debug("Reading cached data of %s from %s", key, path)
-            with open(cached_file, "r", newline="", encoding="utf-8") as file:
-                try:
-                    return json.load(file)
-                except IndexError:
-                    logger.warning("Cached %s is invalid. Removing.")
-                    os.remove(cached_file)
+        pending = dict(headers)
+        with open(path, "rb") as file, open(path + ".tmp", "wb") as output:
+            if (bom := file.read(3)) != codecs.BOM_UTF8:
+                bom = b""
+                file.seek(0)
+            block = [bom]
+            newline = b"\n"
+            for line in file:
+                if not line.startswith(b"#"):
+                    break
+                newline = line[len(line.rstrip(b"\r\n")) :] or newline
+                key = line[1:].split(b":", 1)[0].strip().decode(errors="ignore")
+                if key.lower() in pending:
+                    value = pending.pop(key.lower())
+                    line = _header_line(key.lower(), value, newline)
+                block.append(line)
+            else:
+                line = b""
+            if pending and block[-1] and not block[-1].endswith(b"\n"):
+                block[-1] += newline
+            for attribute, value in pending.items():
+                block.append(_header_line(attribute, value, newline))
+
+            header = b"".join(block)
+            output.write(header)
+            output.write(line)
+            shutil.copyfileobj(file, output)
+        os.replace(path + ".tmp", path)
+        if self._source == path:
+            self._notes_offset = len(header)
+
+    def stage_key(self, stage: str, file_path: str = None, **params) -> str:
+        """Cache key of `stage` result for this song's audio (or `file_path`)"""
+        config = STAGES[stage]
+        if config.source:
+            source = self.stage_key(config.source, file_path)
+        else:
+            source = cache.digest(file_path or self.get_path(self.audio))
+        return cache.key(stage, source, config.model, **config.options, **params)
+
+    def cache_result(self, data, stage: str, **params):
+        cache.write(OUTPUT_DIR, stage, self.stage_key(stage, **params), data)
+
+    def read_cache(self, stage: str, **params):
+        return cache.read(OUTPUT_DIR, stage, self.stage_key(stage, **params))
+
+    def cached_stage(
+        self, stage: str, compute: Callable[[], object], write: bool = True, **params
+    ):
+        """Result of `stage` read from cache, or computed by `compute` and cached
+        (unless `compute` writes it to `cache.path` itself).
+        Result is locked while computed, so others wanting it wait and read it instead
+        """
+        key = self.stage_key(stage, **params)
+        if (result := cache.read(OUTPUT_DIR, stage, key)) is None:
+            with cache.locked(cache.path(OUTPUT_DIR, stage, key, "lock")):
+                # It might have been computed while waiting for the lock
+                if (result := cache.read(OUTPUT_DIR, stage, key)) is None:
+                    result = compute()
+                    if write:
+                        cache.write(OUTPUT_DIR, stage, key, result)
+                    return result
+        logger.debug("Result of %s is cached. Skipping.", stage)
+        metrics.cached()
+        return result
 
     def get_path(self, file: str):
         if self._path:
@@ -158,17 +278,53 @@ class Song(FileOperations):
     _path: str = None
     _transcription: list[transcriber.Utterance] = None
     _pitch_result: list[pitcher.Pitch] = None
+    _activity: np.ndarray = None
+    """Regions of vocals where something is sung, see `activity`"""
     _real_bpm: float = None
+    _audio: AudioSource = None
+    _vocals: AudioSource = None
+    """Separated vocals, unless they were separated losslessly"""
+    _share_audio: bool = False
+    """Whether decoded audio is shared through files in `OUTPUT_DIR`,
+    as stages run in other processes, see `scheduler`"""
+    _metrics: metrics.Record = None
+    """Measurements of stages, see `scheduler`"""
 
     def __post_init__(self):
         super().__post_init__()
         if not self._path:
             self._path = Path(self.audio).parent
-        self._cache = (
-            Path(OUTPUT_DIR)
-            / HTDEMUCS_MODEL
-            / os.path.splitext(Path(self.audio).name)[0]
-        )
+
+    def audio_source(self, file_path: str = None) -> AudioSource:
+        """Original audio (or `file_path`), decoded once and shared by stages"""
+        if self._audio is None:
+            self._audio = AudioSource(
+                file_path or self.get_path(self.audio),
+                directory=OUTPUT_DIR if self._share_audio else None,
+            )
+        return self._audio
+
+    def duration(self) -> float | None:
+        """Length of audio in seconds, if it's decoded already or vocals were separated losslessly"""
+        if self._audio is not None and self._audio.duration is not None:
+            return self._audio.duration
+        if (
+            vocals := separator.load_stem(self.stems_directory(), "vocals")
+        ) is not None:
+            return vocals.duration
+
+    def stems_directory(self, file_path: str = None) -> Path:
+        """Directory of stems separated from `audio` (or `file_path`),
+        named after separation's cache key"""
+        source = file_path or self.get_path(self.audio)
+        if not self._cache or self._cache_source != source:
+            self._cache = (
+                Path(OUTPUT_DIR)
+                / STAGES["separation"].model
+                / self.stage_key("separation", source)
+            )
+            self._cache_source = source
+        return self._cache
 
     def separate_vocals(self, file_path: str = None):
         """Using demucs, separates `vocals` and `instrumental` audio from `audio` or `mp3`"""
@@ -179,9 +335,93 @@ class Song(FileOperations):
         logger.info("Separating vocals from %s", self.audio)
         # os.path.splitext(Path(path).name)[0]
         path = self.get_path(self.audio) if not file_path else file_path
-        output_dir = separator.separate(path)
-        self.vocals = separator.convert(output_dir, "vocals.mp3")
-        self.instrumental = separator.convert(output_dir, "no_vocals.mp3")
+        config = STAGES["separation"]
+        output_dir = separator.separate(
+            self.audio_source(path),
+            config.model,
+            OUTPUT_DIR,
+            self.stems_directory(path).name,
+            **config.options,
+        )
+        self._convert_stems(output_dir)
+
+    @staticmethod
+    def separate_many(songs: list["Song"]):
+        """Same as `separate_vocals` for each of `songs`,
+        with short songs of similar length passed to the model at once"""
+        config = STAGES["separation"]
+        extension = "npy" if config.options.get("lossless") else "mp3"
+        pending = []
+        for song in songs:
+            if song.vocals and song.instrumental:
+                continue
+            if separator.separated(song.stems_directory(), extension):
+                # Only converted
+                song.separate_vocals()
+            else:
+                pending.append(song)
+        if len(pending) < 2:
+            for song in pending:
+                song.separate_vocals()
+            return
+        songs = pending
+        sources = [song.audio_source() for song in songs]
+        for source in sources:
+            # Decoded anyway to be separated
+            source.get()
+        for batch in separator.batches([source.duration for source in sources]):
+            logger.info("Separating vocals of %s songs at once", len(batch))
+            output_dirs = separator.separate_many(
+                [sources[index] for index in batch],
+                config.model,
+                OUTPUT_DIR,
+                [songs[index].stems_directory().name for index in batch],
+                **config.options,
+            )
+            for index, output_dir in zip(batch, output_dirs):
+                songs[index]._convert_stems(output_dir)
+
+    def _convert_stems(self, output_dir: Path):
+        """Converts separated stems into `vocals` and `instrumental` OGG files"""
+        name = os.path.splitext(Path(self.audio).name)[0]
+        extension = "npy" if STAGES["separation"].options.get("lossless") else "mp3"
+        self.vocals = separator.convert(output_dir, f"vocals.{extension}", name=name)
+        self.instrumental = separator.convert(
+            output_dir, f"no_vocals.{extension}", name=name
+        )
+
+    def vocals_source(self) -> AudioSource:
+        """Separated vocals, read from lossless stem if there is one"""
+        vocals = separator.load_stem(self.stems_directory(), "vocals")
+        if vocals is not None:
+            return vocals
+        if self._vocals is None:
+            self._vocals = AudioSource(
+                self.get_cache(self.vocals),
+                directory=OUTPUT_DIR if self._share_audio else None,
+            )
+        return self._vocals
+
+    def detect_activity(self, file_path: str = None):
+        """Finds regions of `vocals` where something is sung"""
+        if not self.vocals:
+            logger.debug("Vocals are not separated. Separating first.")
+            self.separate_vocals(file_path)
+
+        if self._activity is not None:
+            logger.debug("Vocal activity is already available. Skipping.")
+            return
+
+        def detect():
+            logger.info("Detecting vocal activity of %s", self.vocals)
+            vocals = self.vocals_source().get(activity.SAMPLE_RATE, mono=True)
+            regions = activity.detect(
+                vocals, activity.SAMPLE_RATE, **STAGES["activity"].options
+            )
+            logger.debug("Found %s regions with vocals", len(regions))
+            return regions
+
+        self._activity = self.cached_stage("activity", detect)
 
     def transcribe_vocals(self, file_path: str = None):
         """Using whisperx, transcribes `vocals`"""
@@ -193,19 +433,33 @@ class Song(FileOperations):
             logger.debug("Transcription is already available. Skipping.")
             return
 
-        if _cached := self.read_cache(self._cache, "transcription"):
-            logger.debug("Transcription is cached. Skipping.")
-            self._transcription = _cached
-            return
+        language = self.language
+
+        def transcribe():
+            if self._activity is None:
+                logger.debug("Vocal activity is not available. Detecting first.")
+                self.detect_activity()
+
+            logger.info("Transcribing vocals from %s", self.vocals)
+            config = STAGES["transcription"]
+            vocals = self.vocals_source().get(transcriber.SAMPLE_RATE, mono=True)
+            transcription, detected_language = transcriber.transcribe(
+                activity.mask(vocals, transcriber.SAMPLE_RATE, self._activity),
+                language=language,
+                model_name=config.model,
+                **config.options,
+            )
+            logger.debug("Detected language: %s", detected_language)
+            # Cached along with it, so songs reading it get the language as well
+            return {"language": detected_language, "characters": transcription}
 
-        logger.info("Transcribing vocals from %s", self.vocals)
-        self._transcription, detected_language = transcriber.transcribe(
-            self.get_cache(self.vocals), language=self.language
-        )
+        result = self.cached_stage("transcription", transcribe, language=language)
+        if isinstance(result, list):
+            # Cached before language was stored with it
+            result = {"language": None, "characters": result}
         if not self.language:
-            logger.debug("Detected language: %s", detected_language)
-            self.language = detected_language
-        self.cache_result(self._cache, self._transcription, "transcription")
+            self.language = result["language"]
+        self._transcription = result["characters"]
 
     def pitch_vocals(self, file_path: str = None):
         """Using crepe, detects pitch of `vocals`"""
@@ -213,37 +467,44 @@ class Song(FileOperations):
             logger.debug("Vocals are not separated. Separating first.")
             self.separate_vocals(file_path)
 
-        if self._pitch_result:
+        if self._pitch_result is not None:
             logger.debug("Pitch is already available. Skipping.")
             return
-        if _cached := self.read_cache(self._cache, "pitch"):
-            logger.debug("Pitch is cached. Skipping.")
-            self._pitch_result = _cached
-            return
 
-        logger.info("Detecting pitch of vocals from %s", self.vocals)
-        self._pitch_result = pitcher.detect_pitch(self._cache)
-        self.cache_result(self._cache, self._pitch_result, "pitch")
+        def detect():
+            if self._activity is None:
+                logger.debug("Vocal activity is not available. Detecting first.")
+                self.detect_activity()
+
+            logger.info("Detecting pitch of vocals from %s", self.vocals)
+            config = STAGES["pitch"]
+            # Frames are written straight into the cache as they are detected
+            output = cache.path(OUTPUT_DIR, "pitch", self.stage_key("pitch"))
+            os.makedirs(output.parent, exist_ok=True)
+            return pitcher.detect_pitch(
+                self.stems_directory(),
+                model_capacity=config.model,
+                activity=self._activity,
+                output=output,
+                **config.options,
+            )
+
+        self._pitch_result = self.cached_stage("pitch", detect, write=False)
 
     def analyze_bpm(self):
         if self.bpm:
             logger.debug("BPM is already available. Skipping.")
             return
-        if _cached := self.read_cache(self._cache, "bpm"):
-            logger.debug("BPM is cached. Skipping.")
-            self.bpm = _cached["bpm"]
-            self._real_bpm = _cached["real_bpm"]
-            return
 
-        logger.info("Analyzing BPM from %s", self.audio)
-        self._real_bpm = bpm.analyze_bpm(self.get_path(self.audio))
-        self.bpm = self._real_bpm / 4 * bpm.get_multiplier(self._real_bpm / 4)
-        self.cache_result(
-            self._cache,
-            {"bpm": float(self.bpm), "real_bpm": float(self._real_bpm)},
-            "bpm",
-        )
-        logger.info("Detected BPM: %s", self.bpm)
+        def analyze():
+            logger.info("Analyzing BPM from %s", self.audio)
+            real_bpm = bpm.analyze_bpm(self.audio_source(), **STAGES["bpm"].options)
+            song_bpm = real_bpm / 4 * bpm.get_multiplier(real_bpm / 4)
+            logger.info("Detected BPM: %s", song_bpm)
+            return {"bpm": float(song_bpm), "real_bpm": float(real_bpm)}
+
+        result = self.cached_stage("bpm", analyze)
+        self.bpm, self._real_bpm = result["bpm"], result["real_bpm"]
 
     def build_notes(self):
         if not self.bpm:
@@ -252,41 +513,63 @@ class Song(FileOperations):
         if not self._transcription:
             logger.debug("Transcription is not available. Transcribing first.")
             self.transcribe_vocals()
-        if not self._pitch_result:
+        if self._pitch_result is None:
             logger.debug("Pitch is not available. Detecting first.")
             self.pitch_vocals()
 
+        # Imported only once notes are built, as it brings in pandas
+        from mUSh import audio_notes
+
         logger.info("Building notes from transcription and pitch")
-        notes = audio_notes.NoteCollection(self._transcription, self._pitch_result)
+        with metrics.measure("notes.match_pitch", self._metrics):
+            notes = audio_notes.NoteArrays.from_pitch(
+                self._transcription, self._pitch_result
+            )
         if not self.gap:
-            gap = notes.result["start"][1]
+            gap = notes.start[1]
             logger.debug("Setting notes gap to %s", gap)
-            notes.result["start"] -= gap
+            notes.start -= gap
             self.gap = int(gap * 1000)
             logger.debug("Setting gap to %s", self.gap)
         else:
             logger.debug("Setting notes gap to %s", self.gap / 1000)
-            notes.result["start"] -= self.gap / 1000
+            notes.start -= self.gap / 1000
 
-        (
+        with metrics.measure("notes.apply_bpm", self._metrics):
             notes.apply_bpm(self._real_bpm)
-            .merge_punctuation()
-            .merge_spaces()
-            .running_bag()
-            .merge_chars()
-            .normalize_duration()
-        )
-        notes = notes.result.to_numpy()
-        logger.info("Normalizing `NoteCollection` into list of `Note`s")
+        for step in [
+            "merge_punctuation",
+            "merge_spaces",
+            "running_bag",
+            "merge_chars",
+            "normalize_duration",
+        ]:
+            with metrics.measure(f"notes.{step}", self._metrics):
+                getattr(notes, step)()
+        logger.info("Normalizing `NoteArrays` into list of `Note`s")
         self.notes = [
             Note(
                 NoteTypes.NORMAL,
-                row[0],
-                row[1],
-                row[2],
-                row[3],
+                start,
+                duration,
+                pitch,
+                char,
             )
-            if row[3] != "--"
-            else Note(NoteTypes.END_OF_PHRASE, row[0])
-            for row in notes
+            if char != "--"
+            else Note(NoteTypes.END_OF_PHRASE, start)
+            for start, duration, pitch, char in notes.rows()
         ]
+        if self._metrics:
+            self._metrics.duration = self.duration()
+        self.release_audio()
+
+    def release_audio(self):
+        """Frees decoded audio & vocals, along with files they were shared through"""
+        if self._share_audio:
+            # Stages which decoded them might have run in other processes
+            self.audio_source()
+            if self.vocals:
+                self.vocals_source()
+        for source in (self._audio, self._vocals):
+            if source:
+                source.release()
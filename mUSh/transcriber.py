@@ -1,18 +1,11 @@
-from typing import TYPE_CHECKING
-
-if TYPE_CHECKING:
-    from whisperx import (
-        asr as whisper_asr,
-        alignment as whisper_alignment,
-        audio as whisper_audio,
-    )
-else:
-    import whisperx as whisper_asr
-    import whisperx as whisper_alignment
-    import whisperx as whisper_audio
-# NOTE: This is not perfect
-# but at least allows having both proper typing support & lazy loading at runtime
 import msgspec
+import numpy as np
+
+from mUSh import registry
+
+
+SAMPLE_RATE = 16000
+"""Sample rate of audio passed to whisper"""
 
 
 class Utterance(msgspec.Struct):
@@ -23,7 +16,7 @@ class Utterance(msgspec.Struct):
 
 
 def transcribe(
-    audio_file: str,
+    audio_file: str | np.ndarray,
     device: str = "cuda",
     compute_type: str = "int8",
     batch_size: int = 4,
@@ -31,14 +24,26 @@ def transcribe(
     model_name="large-v3",
     character_level: bool = True,
 ):
-    model = whisper_asr.load_model(model_name, device, compute_type=compute_type)
-    audio = whisper_audio.load_audio(audio_file)
+    # whisperx (and torch with it) is imported only once something is transcribed
+    import whisperx
+
+    model = registry.TRANSCRIBERS.get(
+        (model_name, device, compute_type),
+        lambda: whisperx.load_model(model_name, device, compute_type=compute_type),
+    )
+    if isinstance(audio_file, str):
+        audio = whisperx.load_audio(audio_file)
+    else:
+        audio = audio_file
     result = model.transcribe(audio, batch_size=batch_size, language=language)
     detected_language = language or result["language"]
-    model_a, metadata = whisper_alignment.load_align_model(
-        language_code=detected_language, device=device
+    model_a, metadata = registry.ALIGNERS.get(
+        (detected_language, device),
+        lambda: whisperx.load_align_model(
+            language_code=detected_language, device=device
+        ),
     )
-    result_aligned = whisper_alignment.align(
+    result_aligned = whisperx.align(
         result["segments"],
         model_a,
         metadata,